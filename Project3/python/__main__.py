@@ -0,0 +1,29 @@
+import argparse
+import importlib
+
+# subcommand -> module whose main it runs, a module is only imported when its subcommand is used,
+# so tensorflow is never loaded by the subcommands that do not need it
+SUBCOMMANDS = {"emd": "emd",
+               "reduce": "reduce",
+               "train": "autoencoder",
+               "clusterify": "clusterify",
+               "silhouette": "silhouette",
+               "sweep": "sweep",
+               "ann": "ann",
+               "rerank": "rerank",
+               "serve": "server",
+               "loadgen": "loadgen",
+               "benchmark": "benchmark"}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=list(SUBCOMMANDS))
+    parser.add_argument('arguments', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    importlib.import_module(SUBCOMMANDS[args.command]).main(args.arguments)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import argparse
+import re
+import time
+
+import numpy as np
+
+from idx import openImages
+from emd import manhattanNearestNeighbors
+
+# same constants as Hashtable.h
+W = 40
+BUCKET_FACTOR = 128
+
+# defaults of readConfig in Aux.cpp, used for every option missing from the file
+CONFIG_DEFAULTS = {"number_of_clusters": 0,
+                   "number_of_vector_hash_tables": 3,
+                   "number_of_vector_hash_functions": 4,
+                   "max_number_M_hypercube": 10,
+                   "number_of_hypercube_dimensions": 3,
+                   "number_of_probes": 2}
+
+
+def readConfig(filename):
+    config = dict(CONFIG_DEFAULTS)
+
+    with open(filename) as configFile:
+        for line in configFile:
+            line = line.rstrip("\r\n")
+            for option in config:
+                if line.startswith(option):
+                    # like the C++ parser, the value is the number at the end of the line
+                    value = re.search(r"[0-9]+$", line)
+                    if value is None:
+                        raise ValueError(filename + ": no value for " + option)
+                    config[option] = int(value.group())
+
+    return config
+
+
+def powerModulos(pixels, hModulo):
+    # m^i mod M for every dimension, as initializeModulosForHashTable does,
+    # m is less than M / 2 but not a power of 2, so that the powers never become 0
+    m = hModulo // 2 - 1
+    powers = [1] * pixels
+    for power in range(1, pixels):
+        powers[power] = (powers[power - 1] * m) % hModulo
+
+    return np.array(powers, dtype=np.float64)
+
+
+def hashValues(images, disturbances, powers, hModulo, memoryBudget=256 << 20):
+    images = np.asarray(images).reshape(len(images), -1)
+    functionCount, pixels = disturbances.shape
+
+    # the polynomial of calculateH uses the pixels last to first
+    coefficients = powers[::-1]
+    values = np.empty((len(images), functionCount), dtype=np.uint64)
+
+    # every image of a block is compared with every disturbance vector at once
+    blockSize = max(1, memoryBudget // (functionCount * pixels * np.dtype(np.float32).itemsize))
+    for start in range(0, len(images), blockSize):
+        block = np.asarray(images[start:start + blockSize], dtype=np.float32)
+        normalized = np.floor(np.abs(block[:, None, :] - disturbances[None, :, :]) / np.float32(W)) % hModulo
+
+        # bytes give a_i <= 255 / W, so the whole sum stays far below 2^53 and float64 is exact
+        sums = normalized.reshape(-1, pixels) @ coefficients
+        values[start:start + len(block)] = (sums.astype(np.uint64) % np.uint64(hModulo)).reshape(len(block), functionCount)
+
+    return values
+
+
+def bucketize(keys, numberOfBuckets):
+    # buckets as one array of ids plus offsets, members keep their insertion order
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(numberOfBuckets + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=numberOfBuckets), out=offsets[1:])
+
+    return offsets, order
+
+
+def manhattanDistances(queryImage, images, ids):
+    return np.abs(np.asarray(images[ids], dtype=np.int16).reshape(len(ids), -1) - np.asarray(queryImage, dtype=np.int16).reshape(1, -1)).sum(axis=1, dtype=np.int64)
+
+
+def bestCandidates(queryImage, images, candidates, k):
+    distances = manhattanDistances(queryImage, images, candidates)
+
+    # ties go to the lower id, as in kNearestNeighbors
+    order = np.lexsort((candidates, distances))[:k]
+
+    return candidates[order], distances[order]
+
+
+class LSH:
+    def __init__(self, images, L, k, seed=None, memoryBudget=256 << 20):
+        random = np.random.RandomState(seed)
+
+        self.images = images
+        self.L = L
+        self.k = k
+        self.hModulo = 2 ** (32 // k)
+        self.numberOfBuckets = len(images) // BUCKET_FACTOR + 1
+        self.powers = powerModulos(np.asarray(images[:1]).size, self.hModulo)
+        self.memoryBudget = memoryBudget
+
+        # k disturbance vectors s for each of the L hashtables, s_i uniform in [0, W)
+        self.disturbances = random.uniform(0, W, (L * k, self.powers.size)).astype(np.float32)
+
+        keys = self.hash(images)
+        self.buckets = [bucketize(keys[:, table], self.numberOfBuckets) for table in range(L)]
+
+    def hash(self, images):
+        values = hashValues(images, self.disturbances, self.powers, self.hModulo, self.memoryBudget).reshape(-1, self.L, self.k)
+
+        # concatenate the h of every table, 32 / k bits each, in an unsigned int like Hashtable::hashFunction
+        concatenation = np.zeros(values.shape[:2], dtype=np.uint64)
+        for function in range(self.k):
+            concatenation = ((concatenation << np.uint64(32 // self.k)) | values[:, :, function]) & np.uint64(0xFFFFFFFF)
+
+        return (concatenation % np.uint64(self.numberOfBuckets)).astype(np.int64)
+
+    def candidates(self, keys, excludeId=None):
+        # every image sharing a bucket with the query in any table, once
+        candidates = np.unique(np.concatenate([order[offsets[key]:offsets[key + 1]] for (offsets, order), key in zip(self.buckets, keys)]))
+        if excludeId is not None:
+            candidates = candidates[candidates != excludeId]
+
+        return candidates
+
+    def kNearestNeighbors(self, queryImages, k, excludeSelf=False):
+        keys = self.hash(queryImages)
+
+        # excludeSelf means that query i is image i of the index, as when clustering
+        return [bestCandidates(queryImage, self.images, self.candidates(keys[queryIndex], queryIndex if excludeSelf else None), k)
+                for queryIndex, queryImage in enumerate(queryImages)]
+
+    def rangeSearch(self, queryImages, R, excludeSelf=False):
+        keys = self.hash(queryImages)
+
+        results = []
+        for queryIndex, queryImage in enumerate(queryImages):
+            candidates = self.candidates(keys[queryIndex], queryIndex if excludeSelf else None)
+            results.append(candidates[manhattanDistances(queryImage, self.images, candidates) < R])
+
+        return results
+
+
+class HyperCube:
+    def __init__(self, images, k, numberOfPoints, maxVertProbed, seed=None, memoryBudget=256 << 20):
+        random = np.random.RandomState(seed)
+
+        self.images = images
+        self.k = k
+        self.numberOfPoints = numberOfPoints
+        self.maxVertProbed = maxVertProbed
+        self.hModulo = 2 ** (32 // k)
+        self.powers = powerModulos(np.asarray(images[:1]).size, self.hModulo)
+        self.memoryBudget = memoryBudget
+
+        # every projection function maps h values to bits, half of them 1
+        self.projections = np.zeros((k, self.hModulo), dtype=np.uint8)
+        self.projections[:, :self.hModulo // 2] = 1
+        for projection in self.projections:
+            random.shuffle(projection)
+
+        self.disturbances = random.uniform(0, W, (k, self.powers.size)).astype(np.float32)
+
+        # the BFS of hammingNeighbors is the same from every vertex up to xor with the start,
+        # so the probing order is computed once from vertex 0
+        self.probeOrder = [0]
+        visited = {0}
+        for vertex in self.probeOrder:
+            for bit in range(k):
+                if vertex ^ (1 << bit) not in visited:
+                    visited.add(vertex ^ (1 << bit))
+                    self.probeOrder.append(vertex ^ (1 << bit))
+        self.probeOrder = np.array(self.probeOrder, dtype=np.int64)
+
+        self.offsets, self.order = bucketize(self.hash(images), 2 ** k)
+
+    def hash(self, images):
+        values = hashValues(images, self.disturbances, self.powers, self.hModulo, self.memoryBudget).astype(np.int64)
+        bits = self.projections[np.arange(self.k), values]
+
+        # the first function ends up in the most significant bit, as in HyperCube::hashFunction
+        return (bits.astype(np.int64) << np.arange(self.k - 1, -1, -1)).sum(axis=1)
+
+    def candidates(self, vertex, excludeId=None):
+        # visit vertices in BFS order until either the probe or the point budget runs out
+        vertices = vertex ^ self.probeOrder[:self.maxVertProbed]
+        candidates = np.concatenate([self.order[self.offsets[vertex]:self.offsets[vertex + 1]] for vertex in vertices])
+        if excludeId is not None:
+            candidates = candidates[candidates != excludeId]
+
+        return candidates[:self.numberOfPoints]
+
+    def kNearestNeighbors(self, queryImages, k, excludeSelf=False):
+        vertices = self.hash(queryImages)
+
+        return [bestCandidates(queryImage, self.images, self.candidates(vertices[queryIndex], queryIndex if excludeSelf else None), k)
+                for queryIndex, queryImage in enumerate(queryImages)]
+
+    def rangeSearch(self, queryImages, R, excludeSelf=False):
+        vertices = self.hash(queryImages)
+
+        results = []
+        for queryIndex, queryImage in enumerate(queryImages):
+            candidates = self.candidates(vertices[queryIndex], queryIndex if excludeSelf else None)
+            results.append(candidates[manhattanDistances(queryImage, self.images, candidates) < R])
+
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d')
+    parser.add_argument('-q')
+    parser.add_argument('-o')
+    parser.add_argument('-c')
+    parser.add_argument('-method', default="LSH", choices=["LSH", "Hypercube"])
+    parser.add_argument('-L')
+    parser.add_argument('-k')
+    parser.add_argument('-M')
+    parser.add_argument('-probes')
+    parser.add_argument('-N', default="1")
+    parser.add_argument('-R', default="10000")
+    parser.add_argument('-seed')
+    args = parser.parse_args(argv)
+
+    # the config file gives the defaults, the command line overrides them
+    config = readConfig(args.c) if args.c is not None else dict(CONFIG_DEFAULTS)
+    L = int(args.L) if args.L is not None else config["number_of_vector_hash_tables"]
+    M = int(args.M) if args.M is not None else config["max_number_M_hypercube"]
+    probes = int(args.probes) if args.probes is not None else config["number_of_probes"]
+    if args.k is not None:
+        k = int(args.k)
+    elif args.method == "LSH":
+        k = config["number_of_vector_hash_functions"]
+    else:
+        k = config["number_of_hypercube_dimensions"]
+
+    N = int(args.N)
+    R = float(args.R)
+    seed = int(args.seed) if args.seed is not None else None
+
+    inputImages = openImages(args.d)
+    inputImages = inputImages.reshape(len(inputImages), -1)
+    queryImages = openImages(args.q)
+    queryImages = queryImages.reshape(len(queryImages), -1)
+
+    if args.method == "LSH":
+        index = LSH(inputImages, L, k, seed)
+    else:
+        index = HyperCube(inputImages, k, M, probes, seed)
+
+    approximateStart = time.perf_counter()
+    approximateNeighbors = index.kNearestNeighbors(queryImages, N)
+    approximateTime = time.perf_counter() - approximateStart
+
+    trueStart = time.perf_counter()
+    trueNeighbors = manhattanNearestNeighbors(queryImages, inputImages, N)
+    trueTime = time.perf_counter() - trueStart
+
+    rangeNeighbors = index.rangeSearch(queryImages, R)
+
+    # same layout as calculateOutput of the C++ search programs, times are per query set
+    with open(args.o, mode='w') as outputFile:
+        for queryIndex, queryImage in enumerate(queryImages):
+            outputFile.write("Query: " + str(queryIndex + 1) + "\n")
+
+            neighbors, distances = approximateNeighbors[queryIndex]
+            trueDistances = manhattanDistances(queryImage, inputImages, trueNeighbors[queryIndex])
+            for neighborIndex in range(len(neighbors)):
+                outputFile.write("Nearest neighbor-" + str(neighborIndex + 1) + ": " + str(neighbors[neighborIndex]) + "\n")
+                outputFile.write("distance" + ("LSH" if args.method == "LSH" else "HyperCube") + ": " + str(distances[neighborIndex]) + "\n")
+                outputFile.write("distanceTrue: " + str(trueDistances[neighborIndex]) + "\n")
+
+            outputFile.write("R-near neighbors:\n")
+            for rangeNeighbor in rangeNeighbors[queryIndex]:
+                outputFile.write(str(rangeNeighbor) + "\n")
+
+        outputFile.write("t" + ("LSH" if args.method == "LSH" else "HyperCube") + ": " + str(approximateTime) + "\n")
+        outputFile.write("tTrue: " + str(trueTime) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,126 @@
-import sys
+import os
+import re
+import glob
 import argparse
+import time
 
 import numpy as np
-import tensorflow.keras
+import tensorflow as tf
 
-from tensorflow.keras.layers import Dropout,Conv2D,MaxPooling2D,UpSampling2D,Input,Reshape,Dense,Flatten,Conv2DTranspose
+from tensorflow.keras.layers import Conv2D,MaxPooling2D,Input,Reshape,Dense,Flatten,Conv2DTranspose
 from keras.layers.normalization import BatchNormalization
-from keras.models import Model,Sequential
+from keras.models import Sequential,load_model
 from keras.optimizers import RMSprop
+from keras.callbacks import Callback,EarlyStopping
 
-from sklearn.model_selection import train_test_split
+from idx import openImages
 
-def readImages(filename):
-    with open(filename, mode='rb') as bytestream:
-        # throw away magic number
-        bytestream.read(4)
-        # read the number of images from the metadata
-        numOfImages = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of rows from the metadata
-        numOfRows = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of columns from the metadata
-        numOfColumns = int.from_bytes(bytestream.read(4), byteorder='big')
+# images read from the memory map at a time by the input pipeline
+READ_BLOCK_SIZE = 4096
 
-        # read actual image data
-        buf = bytestream.read(numOfRows * numOfColumns * numOfImages)
-        # convert data from bytes to numpy array
-        data = np.frombuffer(buf, dtype=np.uint8).astype(np.float32)
-        # reshape so we can access the data of an image
-        data = data.reshape(numOfImages, numOfRows, numOfColumns)
 
-        return data
+def imageDataset(images, indexes, maxPixel, batch_size, shuffle=False, cache=False):
+    numberOfRows, numberOfColumns = images.shape[1:]
 
+    # read the selected images block by block straight from the memory map
+    def readBlocks():
+        for start in range(0, len(indexes), READ_BLOCK_SIZE):
+            yield images[indexes[start:start + READ_BLOCK_SIZE]]
 
-def autoencoder(trainData, trainLabels, valData, valLabels, batch_size, epochs):
+    dataset = tf.data.Dataset.from_generator(readBlocks, output_signature=tf.TensorSpec((None, numberOfRows, numberOfColumns), tf.uint8))
+    dataset = dataset.unbatch()
 
-    # extracting row and column information
-    numberOfRows = trainData.shape[1]
-    numberOfColumns = trainData.shape[2]
+    # cached images stay bytes, a quarter of their normalized size
+    if cache:
+        dataset = dataset.cache()
+
+    if shuffle:
+        dataset = dataset.shuffle(min(len(indexes), 8 * READ_BLOCK_SIZE), reshuffle_each_iteration=True)
+
+    dataset = dataset.batch(batch_size)
+
+    # normalize on the fly, the same tensor is both the input and the target of the autoencoder
+    def normalize(batch):
+        batch = tf.expand_dims(tf.cast(batch, tf.float32) / maxPixel, -1)
+        return batch, batch
+
+    dataset = dataset.map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+class EpochCheckpoint(Callback):
+    def __init__(self, checkpointDirectory, every):
+        super().__init__()
+        self.checkpointDirectory = checkpointDirectory
+        self.every = every
+
+    def on_epoch_end(self, epoch, logs=None):
+        # the whole model is saved, optimizer state included, so training can resume from it
+        if (epoch + 1) % self.every == 0:
+            self.model.save(os.path.join(self.checkpointDirectory, "epoch-%04d.h5" % (epoch + 1)))
+
+
+class ThroughputLogger(Callback):
+    def __init__(self, imagesPerEpoch, logFilePath=None):
+        super().__init__()
+        self.imagesPerEpoch = imagesPerEpoch
+        self.logFilePath = logFilePath
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epochStart = time.perf_counter()
+        self.stepTimes = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.stepStart = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.stepTimes.append(time.perf_counter() - self.stepStart)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # validation is part of the epoch time, so images/sec is measured over the training steps only
+        trainingTime = sum(self.stepTimes)
+        imagesPerSecond = self.imagesPerEpoch / trainingTime if trainingTime > 0 else 0.0
+        meanStepTime = trainingTime / max(1, len(self.stepTimes))
+        epochTime = time.perf_counter() - self.epochStart
+
+        print("epoch %d: %.1f images/sec, %.2f ms/step, %.1f s total" % (epoch + 1, imagesPerSecond, meanStepTime * 1000, epochTime))
+
+        if self.logFilePath is not None:
+            writeHeader = not os.path.exists(self.logFilePath)
+            with open(self.logFilePath, mode='a') as logFile:
+                if writeHeader:
+                    logFile.write("epoch,images_per_second,mean_step_time,epoch_time,loss,val_loss\n")
+                logFile.write("%d,%f,%f,%f,%s,%s\n" % (epoch + 1, imagesPerSecond, meanStepTime, epochTime, (logs or {}).get('loss'), (logs or {}).get('val_loss')))
+
+
+def latestCheckpoint(checkpointDirectory):
+    # checkpoints are named after the number of epochs they completed
+    checkpoints = []
+    for checkpointPath in glob.glob(os.path.join(glob.escape(checkpointDirectory), "epoch-*.h5")):
+        match = re.search(r"epoch-(\d+)\.h5$", checkpointPath)
+        if match:
+            checkpoints.append((int(match.group(1)), checkpointPath))
+
+    if not checkpoints:
+        return None, 0
+
+    epoch, checkpointPath = max(checkpoints)
+    return checkpointPath, epoch
+
+
+def autoencoder(trainData, valData, numberOfRows, numberOfColumns, epochs, jitCompile=False,
+                latentSize=10, filters=(32, 64, 128), callbacks=None, model=None, initialEpoch=0):
+
+    # a model restored from a checkpoint just continues training
+    if model is not None:
+        model.fit(trainData,
+                            validation_data=valData,
+                            epochs=epochs,
+                            initial_epoch=initialEpoch,
+                            callbacks=callbacks,
+                            verbose=1)
+        return model
 
     # implementing our cnn using the given template from eclass
     # create an empty model
@@ -46,73 +130,121 @@ def autoencoder(trainData, trainLabels, valData, valLabels, batch_size, epochs):
     model.add(Input(shape = (numberOfRows, numberOfColumns, 1)))
 
     # including encoding layers
-    model.add(Conv2D(32, (3, 3), activation='relu', padding='same'))
+    model.add(Conv2D(filters[0], (3, 3), activation='relu', padding='same'))
     model.add(BatchNormalization())
     model.add(MaxPooling2D((2, 2)))
 
-    model.add(Conv2D(64, (3, 3), activation='relu', padding='same'))
+    model.add(Conv2D(filters[1], (3, 3), activation='relu', padding='same'))
     model.add(BatchNormalization())
     model.add(MaxPooling2D((2, 2)))
 
-    model.add(Conv2D(128, (3, 3), activation='relu', padding='same'))
+    model.add(Conv2D(filters[2], (3, 3), activation='relu', padding='same'))
     model.add(BatchNormalization())
     model.add(MaxPooling2D((2, 2)))
 
     # adding flat and dense layer 
     model.add(Flatten())
-    model.add(Dense(10, activation='relu'))
+    model.add(Dense(latentSize, activation='relu'))
 
     # adding new dense and reshape layer
-    model.add(Dense(1152, activation='relu'))
-    model.add(Reshape((3,3,128)))
+    model.add(Dense(3 * 3 * filters[2], activation='relu'))
+    model.add(Reshape((3,3,filters[2])))
 
     # inlcuding decoding layers
-    model.add(Conv2DTranspose(64, (3, 3), strides=(2,2), activation='relu', padding='VALID'))
+    model.add(Conv2DTranspose(filters[1], (3, 3), strides=(2,2), activation='relu', padding='VALID'))
     model.add(BatchNormalization())
 
-    model.add(Conv2DTranspose(32, (3, 3), strides=(2,2), activation='relu', padding='same'))
+    model.add(Conv2DTranspose(filters[0], (3, 3), strides=(2,2), activation='relu', padding='same'))
     model.add(BatchNormalization())
 
     # adding final layer with sigmoid activation function
-    model.add(Conv2DTranspose(1, (3, 3), strides=(2,2), activation='sigmoid', padding='same'))
+    # under mixed precision the output stays float32 so that the loss is computed in full precision
+    model.add(Conv2DTranspose(1, (3, 3), strides=(2,2), activation='sigmoid', padding='same', dtype='float32'))
 
-    model.compile(loss = 'mean_squared_error', optimizer = RMSprop())
+    model.compile(loss = 'mean_squared_error', optimizer = RMSprop(), jit_compile=jitCompile)
 
     model.summary()
     
-    model.fit(trainData, trainLabels, 
-                        validation_data=(valData, valLabels),
-                        batch_size=batch_size,
+    # the datasets are already batched and yield (input, target) pairs
+    model.fit(trainData,
+                        validation_data=valData,
                         epochs=epochs,
+                        callbacks=callbacks,
                         verbose=1)
     
     # finally we have to make sure that history object and model are returned
     return model
 
 
-def main():
-
-    datasetFilePath = "../originalSpace/trainData"
-
-    # read the data into memory once
-    inputData = readImages(datasetFilePath)
-    inputData = inputData.reshape(-1, 28,28, 1)
-    inputData = inputData / np.max(inputData)
-
-
-    train_X,valid_X,train_ground,valid_ground = train_test_split(inputData,
-                                                                inputData,
-                                                                test_size=0.2,
-                                                                random_state=13)
-
-    
-    batch_size = 64
-    epochs = 10
-
-    model = autoencoder(train_X, train_ground, valid_X, valid_ground, batch_size, epochs)
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', default="../originalSpace/trainData")
+    parser.add_argument('-o', default="../models/autoencoderTest.h5")
+    parser.add_argument('-latent', default="10")
+    parser.add_argument('-filters', default="32,64,128")
+    parser.add_argument('-batch', default="64")
+    parser.add_argument('-epochs', default="10")
+    parser.add_argument('-checkpoints', default="../models/checkpoints")
+    parser.add_argument('-checkpoint-every', default="1")
+    parser.add_argument('-resume', action='store_true')
+    parser.add_argument('-patience', default="0")
+    parser.add_argument('-log')
+    parser.add_argument('-cache', action='store_true')
+    parser.add_argument('-mixed-precision', action='store_true')
+    parser.add_argument('-xla', action='store_true')
+    args = parser.parse_args(argv)
+
+    datasetFilePath = args.d
+    outputFilePath = args.o
+    latentSize = int(args.latent)
+    filters = [int(width) for width in args.filters.split(",")]
+    batch_size = int(args.batch)
+    epochs = int(args.epochs)
+    checkpointDirectory = args.checkpoints
+    patience = int(args.patience)
+
+    # the decoder mirrors three pooling steps, 28 -> 14 -> 7 -> 3
+    if len(filters) != 3:
+        parser.error("-filters needs exactly three comma separated widths")
+
+    # bfloat16 is the half precision type that is fast on cpus
+    if args.mixed_precision:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    # map the data instead of reading it into memory
+    inputData = openImages(datasetFilePath)
+    numberOfImages, numberOfRows, numberOfColumns = inputData.shape
+    maxPixel = float(inputData.max())
+
+    # hold out a random fifth of the images for validation, indexes are sorted to keep reads sequential
+    permutation = np.random.RandomState(13).permutation(numberOfImages)
+    validationSize = int(np.ceil(numberOfImages * 0.2))
+    validationIndexes = np.sort(permutation[:validationSize])
+    trainIndexes = np.sort(permutation[validationSize:])
+
+    trainData = imageDataset(inputData, trainIndexes, maxPixel, batch_size, shuffle=True, cache=args.cache)
+    validData = imageDataset(inputData, validationIndexes, maxPixel, batch_size, cache=args.cache)
+
+    os.makedirs(checkpointDirectory, exist_ok=True)
+    callbacks = [EpochCheckpoint(checkpointDirectory, int(args.checkpoint_every)), ThroughputLogger(len(trainIndexes), args.log)]
+
+    if patience > 0:
+        callbacks.append(EarlyStopping(monitor='val_loss', patience=patience, restore_best_weights=True))
+
+    # pick up from the last completed epoch if asked to
+    model = None
+    initialEpoch = 0
+    if args.resume:
+        checkpointPath, initialEpoch = latestCheckpoint(checkpointDirectory)
+        if checkpointPath is not None:
+            print("resuming from " + checkpointPath)
+            model = load_model(checkpointPath)
+
+    model = autoencoder(trainData, validData, numberOfRows, numberOfColumns, epochs, args.xla,
+                        latentSize, filters, callbacks, model, initialEpoch)
 
     # saving the model
-    model.save("../models/autoencoderTest.h5")
+    model.save(outputFilePath)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
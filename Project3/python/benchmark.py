@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+from functools import partial
+from itertools import cycle
+
+import numpy as np
+
+import idx
+import emd
+import ann
+
+
+def syntheticImages(numOfImages, seed):
+    random = np.random.RandomState(seed)
+
+    # one blurred stroke per image, its position and width depend on a fake label
+    labels = random.randint(0, 10, numOfImages)
+    y, x = np.mgrid[0:28, 0:28]
+    centerX = 6 + 1.5 * labels[:, None, None] + random.normal(0, 1, (numOfImages, 1, 1))
+    centerY = 14 + random.normal(0, 2, (numOfImages, 1, 1))
+    spread = 3 + labels[:, None, None] % 3
+
+    images = 255 * np.exp(-((x - centerX) ** 2 + (y - centerY) ** 2) / (2 * spread ** 2))
+    images += random.normal(0, 20, images.shape)
+
+    return np.clip(images, 0, 255).astype(np.uint8), labels
+
+
+def writeFixtures(directory, numOfImages, numOfQueries):
+    paths = {}
+
+    for name, count, seed in (("input", numOfImages, 1), ("query", numOfQueries, 2)):
+        images, labels = syntheticImages(count, seed)
+
+        paths[name + "Images"] = os.path.join(directory, name + "Images")
+        idx.writeImages(paths[name + "Images"], images)
+
+        paths[name + "Labels"] = os.path.join(directory, name + "Labels")
+        with open(paths[name + "Labels"], mode='wb') as binaryFile:
+            binaryFile.write(np.array([idx.LABELS_MAGIC, count], dtype='>u4').tobytes())
+            binaryFile.write(labels.astype(np.uint8).tobytes())
+
+    return paths
+
+
+def measure(function, repeat):
+    # calibrate the number of calls so that every sample takes at least a tenth of a second
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    samples = [sample / number for sample in timer.repeat(repeat=repeat, number=number)]
+
+    return {"min": min(samples), "median": float(np.median(samples)), "calls": number}
+
+
+def cycledDistance(pairs, window, solver):
+    image, otherImage = next(pairs)
+
+    return emd.earthMoverDistance(window, window, image, otherImage, solver)
+
+
+def benchmarks(paths, directory):
+    inputImages = idx.openImages(paths["inputImages"])
+    inputImages = inputImages.reshape(len(inputImages), -1)
+    queryImages = idx.openImages(paths["queryImages"])
+    queryImages = queryImages.reshape(len(queryImages), -1)
+    inputLabels = idx.readLabels(paths["inputLabels"])
+    queryLabels = idx.readLabels(paths["queryLabels"])
+
+    pair = np.asarray(inputImages[:2])
+    latents = np.random.RandomState(3).randint(0, 256, (len(inputImages), 1, 10))
+    settings = {"width": 7, "height": 7, "solver": "transport", "search": "prune", "memoryBudget": 256 << 20,
+                "mode": "exact", "regularization": 1.0, "iterations": 200}
+
+    cases = {
+        "idx.openImages": partial(idx.openImages, paths["inputImages"]),
+        "idx.readImages": partial(idx.readImages, paths["inputImages"]),
+        "idx.writeImages": partial(idx.writeImages, os.path.join(directory, "latents"), latents, idx.REDUCED_MAGIC),
+        "emd.manhattanDistance": partial(emd.manhattanDistance, pair[0].astype(np.float32), pair[1].astype(np.float32)),
+        "emd.kNearestNeighbors/manhattan": partial(emd.kNearestNeighbors, queryImages[0].astype(np.float32), inputImages[:100].astype(np.float32), 10, emd.manhattanDistance),
+        "emd.manhattanNearestNeighbors": partial(emd.manhattanNearestNeighbors, queryImages, inputImages, 10),
+        "emd.evaluate/7x7": partial(emd.evaluate, inputImages, inputLabels, queryImages, queryLabels, settings),
+        "ann.LSH": partial(ann.LSH, inputImages, 5, 4, 0),
+        "ann.HyperCube": partial(ann.HyperCube, inputImages, 3, 30, 4, 0),
+    }
+
+    lsh = ann.LSH(inputImages, 5, 4, 0)
+    hyperCube = ann.HyperCube(inputImages, 3, 30, 4, 0)
+    cases["ann.LSH.kNearestNeighbors"] = partial(lsh.kNearestNeighbors, queryImages, 10)
+    cases["ann.HyperCube.kNearestNeighbors"] = partial(hyperCube.kNearestNeighbors, queryImages, 10)
+
+    # every call solves the next of a few different pairs, a single pair would time one easy problem over and over
+    pairs = np.asarray(inputImages[:16]).reshape(8, 2, -1)
+    for window in (28, 14, 7, 4):
+        cases["emd.computeSignatures/" + str(window)] = partial(emd.computeSignatures, inputImages, window, window)
+        for solver in ("transport", "linprog", "grid"):
+            cases["emd.earthMoverDistance/" + str(window) + "/" + solver] = partial(cycledDistance, cycle(pairs), window, solver)
+
+    # only the grid solver is practical for the fine windows
+    for window in (2, 1):
+        cases["emd.earthMoverDistance/" + str(window) + "/grid"] = partial(cycledDistance, cycle(pairs), window, "grid")
+
+    return cases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-images', default="2000")
+    parser.add_argument('-queries', default="20")
+    parser.add_argument('-repeat', default="5")
+    parser.add_argument('-filter', default="")
+    parser.add_argument('-save')
+    parser.add_argument('-compare')
+    parser.add_argument('-threshold', default="1.2")
+    args = parser.parse_args(argv)
+
+    threshold = float(args.threshold)
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)["results"]
+
+    results = {}
+    regressions = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = writeFixtures(directory, int(args.images), int(args.queries))
+
+        for name, function in benchmarks(paths, directory).items():
+            if args.filter not in name:
+                continue
+
+            results[name] = measure(function, int(args.repeat))
+
+            # compare medians, min is too sensitive to one lucky run
+            line = "%-45s %12.6f ms" % (name, results[name]["median"] * 1000)
+            if name in baseline:
+                change = results[name]["median"] / baseline[name]["median"]
+                line += "  x%.2f" % change
+                if change > threshold:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line)
+
+    if args.save is not None:
+        with open(args.save, mode='w') as baselineFile:
+            json.dump({"images": int(args.images), "queries": int(args.queries), "results": results}, baselineFile, indent=2)
+
+    if regressions:
+        print(str(len(regressions)) + " benchmark(s) slower than x" + str(threshold) + " of the baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,79 @@
-import sys
 import argparse
 
-import math
 import numpy as np
-import keras
-from matplotlib import pyplot as plt
 
-from keras.layers import Dropout,Conv2D,MaxPooling2D,UpSampling2D,Input,Flatten,Dense
-from keras.layers.normalization import BatchNormalization
-from keras.models import Model,Sequential
-from keras.optimizers import RMSprop
-from keras.utils import to_categorical
+from idx import openImages
 
 
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, classification_report, confusion_matrix
+def predictClasses(classifierModel, images, batchSize):
+    numOfImages, numOfRows, numOfColumns = images.shape
 
+    # inputs are scaled by the largest pixel of the file, found without loading it
+    maxPixel = float(images.max())
 
-import pandas as pd
+    classes = np.empty(numOfImages, dtype=np.int64)
 
+    for start in range(0, numOfImages, batchSize):
+        batch = np.asarray(images[start:start + batchSize], dtype=np.float32)
+        batch /= maxPixel
 
-def readImages(filename):
-    with open(filename, mode='rb') as bytestream:
-        # throw away magic number
-        bytestream.read(4)
-        # read the number of images from the metadata
-        numOfImages = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of rows from the metadata
-        numOfRows = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of columns from the metadata
-        numOfColumns = int.from_bytes(bytestream.read(4), byteorder='big')
+        # the class of every image is the position of its highest output
+        predictions = classifierModel.predict_on_batch(batch.reshape(-1, numOfRows, numOfColumns, 1))
+        classes[start:start + len(batch)] = np.argmax(predictions, axis=1)
 
-        # read actual image data
-        buf = bytestream.read(numOfRows * numOfColumns * numOfImages)
-        # convert data from bytes to numpy array
-        data = np.frombuffer(buf, dtype=np.uint8).astype(np.float32)
-        # reshape so we can access the data of an image
-        data = data.reshape(numOfImages, numOfRows, numOfColumns)
+    return classes
 
-        return data
-    
-  
+def writeClusters(outputFilePath, classes, numberOfClusters):
+    if len(classes) and classes.max() >= numberOfClusters:
+        raise ValueError("model predicts class " + str(classes.max()) + " but only " + str(numberOfClusters) + " clusters were asked for")
 
-def main():
+    # image ids grouped by cluster, ascending within each cluster
+    order = np.argsort(classes, kind='stable')
+    sizes = np.bincount(classes, minlength=numberOfClusters)
+    ends = np.cumsum(sizes)
+
+    # one line per cluster in the format readClustersFromFile expects, built in memory
+    lines = []
+    for clusterIndex in range(numberOfClusters):
+        cluster = order[ends[clusterIndex] - sizes[clusterIndex]:ends[clusterIndex]]
+        lines.append("CLUSTER-" + str(clusterIndex + 1) + " { size: " + str(len(cluster)) + "".join([", " + str(imageNumber) for imageNumber in cluster.tolist()]) + "}\n")
+
+    with open(outputFilePath, mode='w') as file:
+        file.write("".join(lines))
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d')
     parser.add_argument('-model')
     parser.add_argument('-k')
     parser.add_argument('-o')
-    args = parser.parse_args()
+    parser.add_argument('-batch', default="1024")
+    parser.add_argument('-npz')
+    args = parser.parse_args(argv)
 
     datasetFilePath = args.d
     modelFilePath = args.model
     numberOfClusters = int(args.k)
     outputFilePath = args.o
+    batchSize = int(args.batch)
 
-    # read the data into memory once
-    inputData = readImages(datasetFilePath)
-    inputData = inputData.reshape(-1, 28,28, 1)
-    inputData = inputData / np.max(inputData)
+    # map the data instead of reading it into memory
+    inputData = openImages(datasetFilePath)
 
-    # read the model into memory so we can classify and then create the cluster file
-    classifierModel = keras.models.load_model(modelFilePath)
+    # read the model into memory so we can classify and then create the cluster file,
+    # keras is only imported once there is a model to load
+    from keras.models import load_model
+    classifierModel = load_model(modelFilePath)
 
-    # predict the classes of the input data
-    classes = [np.argmax(oneHot) for oneHot in classifierModel.predict(inputData)]
+    # predict the classes of the input data batch by batch
+    classes = predictClasses(classifierModel, inputData, batchSize)
 
     # now write cluster output based on classes
-    clusters = [[] for _ in range(numberOfClusters)]
-
-    for predictionIndex in range(len(classes)):
-        clusters[classes[predictionIndex]].append(predictionIndex)
+    writeClusters(outputFilePath, classes, numberOfClusters)
 
-    with open(outputFilePath, mode='w') as file:
-        clusterIndex = 1
-        for cluster in clusters:
-            file.write("CLUSTER-" + str(clusterIndex) + " { size: " + str(len(cluster)))
-            for imageNumber in cluster:
-                file.write(", " + str(imageNumber))
-            file.write("}\n")
-            clusterIndex += 1
+    # large datasets can also get their assignments in binary form
+    if args.npz is not None:
+        np.savez_compressed(args.npz, classes=classes, sizes=np.bincount(classes, minlength=numberOfClusters))
    
 if __name__ == "__main__":
     main()
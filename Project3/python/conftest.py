@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+
+def sparseImages(numOfImages, seed):
+    random = np.random.RandomState(seed)
+
+    # random pixels on a black background, most windows get some brightness
+    images = random.randint(0, 256, (numOfImages, 28, 28))
+    images[random.uniform(size=images.shape) < 0.7] = 0
+
+    return images.astype(np.uint8)
+
+
+def strokeImages(numOfImages, seed):
+    random = np.random.RandomState(seed)
+
+    # one blurred stroke per image like the digits, so the brightness sits in a few windows
+    labels = random.randint(0, 10, numOfImages)
+    y, x = np.mgrid[0:28, 0:28]
+    centerX = 6 + 1.5 * labels[:, None, None] + random.normal(0, 1, (numOfImages, 1, 1))
+    centerY = 14 + random.normal(0, 2, (numOfImages, 1, 1))
+    spread = 3 + labels[:, None, None] % 3
+
+    images = 255 * np.exp(-((x - centerX) ** 2 + (y - centerY) ** 2) / (2 * spread ** 2))
+    images += random.normal(0, 20, images.shape)
+
+    return np.clip(images, 0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def randomImages():
+    return sparseImages
+
+
+@pytest.fixture
+def digitImages():
+    return strokeImages
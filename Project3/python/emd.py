@@ -1,48 +1,22 @@
 import argparse
 import bisect
+import glob
+import hashlib
+import json
+import os
+import time
 import numpy as np
+from multiprocessing import Pool, shared_memory
 import math
-from scipy.optimize import linprog
 from functools import partial
 
+from idx import openImages, readLabels, fileHash
+from transport import transportationSimplex
+
 import warnings
 warnings.filterwarnings("ignore")
 
 
-def readLabels(filename):
-    with open(filename, mode='rb') as bytestream:
-        # throw away magic number
-        bytestream.read(4)
-        # read the number of labels from the metadata
-        numOfLabels = int.from_bytes(bytestream.read(4), byteorder='big')
-      
-        # read actual label data
-        buf = bytestream.read(numOfLabels)
-        # convert data from bytes to numpy array
-        labels = np.frombuffer(buf, dtype=np.uint8).astype(np.int64)
-
-        return labels
-
-def readImages(filename):
-    with open(filename, mode='rb') as bytestream:
-        # throw away magic number
-        bytestream.read(4)
-        # read the number of images from the metadata
-        numOfImages = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of rows from the metadata
-        numOfRows = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of columns from the metadata
-        numOfColumns = int.from_bytes(bytestream.read(4), byteorder='big')
-
-        # read actual image data
-        buf = bytestream.read(numOfRows * numOfColumns * numOfImages)
-        # convert data from bytes to numpy array
-        data = np.frombuffer(buf, dtype=np.uint8).astype(np.float32)
-        # reshape so we can access the data of an image
-        data = data.reshape(numOfImages, numOfRows * numOfColumns)
-
-        return data
-
 def kNearestNeighbors(queryImage, otherImages, k, distFunc):
     neighborsWithDistances = []
     currId = 0
@@ -65,6 +39,62 @@ def kNearestNeighbors(queryImage, otherImages, k, distFunc):
 
     return [neighborId for (_, neighborId) in neighborsWithDistances]
 
+class Profiler:
+    def __init__(self):
+        self.stages = {}
+        self.solves = 0
+        self.iterations = 0
+        self.maxIterations = 0
+        self.failures = {}
+
+    def add(self, stage, seconds, calls=1):
+        totals = self.stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += calls
+
+    def addSolve(self, iterations, status):
+        self.solves += 1
+        self.iterations += iterations
+        self.maxIterations = max(self.maxIterations, iterations)
+
+        # linprog status 0 is success, anything else means res.fun cannot be trusted
+        if status != 0:
+            self.failures[status] = self.failures.get(status, 0) + 1
+
+    def merge(self, other):
+        for stage, (seconds, calls) in other.stages.items():
+            self.add(stage, seconds, calls)
+        self.solves += other.solves
+        self.iterations += other.iterations
+        self.maxIterations = max(self.maxIterations, other.maxIterations)
+        for status, count in other.failures.items():
+            self.failures[status] = self.failures.get(status, 0) + count
+
+    def report(self, queryLatencies):
+        stages = {stage: {"seconds": seconds, "calls": calls} for stage, (seconds, calls) in self.stages.items()}
+
+        # whatever the emd search spent outside bounds and solves is kNN bookkeeping
+        if "emd_search" in self.stages:
+            inner = sum(self.stages[stage][0] for stage in ("setup", "solve", "bounds") if stage in self.stages)
+            stages["knn_bookkeeping"] = {"seconds": self.stages["emd_search"][0] - inner, "calls": self.stages["emd_search"][1]}
+
+        latencies = np.array(queryLatencies) if len(queryLatencies) else np.zeros(1)
+
+        return {"stages": stages,
+                "solver": {"solves": self.solves,
+                           "iterations": self.iterations,
+                           "meanIterations": self.iterations / self.solves if self.solves else 0.0,
+                           "maxIterations": self.maxIterations,
+                           "failures": {str(status): count for status, count in self.failures.items()}},
+                "queryLatency": {"mean": float(latencies.mean()),
+                                 "p50": float(np.percentile(latencies, 50)),
+                                 "p90": float(np.percentile(latencies, 90)),
+                                 "p99": float(np.percentile(latencies, 99)),
+                                 "max": float(latencies.max())}}
+
+# per stage timings, only collected when -profile is given, otherwise every check is a single None test
+profiler = None
+
 def windowIndexToCentroid(width, height, index):
     verticalSlots = 28 // height
     horizontalSlots = 28 // width
@@ -91,121 +121,690 @@ def manhattanDistance(image, otherImage):
     return s
 
 
-def earthMoverDistance(inputWidth, inputHeight, image, otherImage):
-    # window dimensions for emd
-    windowWidth = inputWidth
-    windowHeight = inputHeight
+# ground distances and window centroids per window geometry
+geometryCache = {}
+# linprog constraint matrices per window geometry, only built when linprog is used
+constraintCache = {}
+# grid graph edges per window geometry, only built when the grid solver is used
+gridCache = {}
+
+def windowCentroids(width, height):
+    windowCount = (28 // width) * (28 // height)
+
+    return np.array([windowIndexToCentroid(width, height, index) for index in range(windowCount)])
+
+def windowGeometry(width, height):
+    key = (width, height)
+
+    if key not in geometryCache:
+        # distance between every pair of window centroids, flow Fij is at i * windowCount + j
+        centroids = windowCentroids(width, height)
+        costs = np.sqrt(np.sum((centroids[:, None, :] - centroids[None, :, :]) ** 2, axis=2))
+
+        geometryCache[key] = (costs, centroids)
+
+    return geometryCache[key]
+
+def windowConstraints(width, height):
+    key = (width, height)
+
+    if key not in constraintCache:
+        # scipy is only imported by the runs that solve with linprog
+        from scipy.sparse import csr_matrix
+
+        windowCount = (28 // width) * (28 // height)
+
+        # sum over j of Fij = wi for every i, then sum over i of Fij = w'j for every j
+        flowIndexes = np.arange(windowCount * windowCount)
+        rowIndexes = np.concatenate((flowIndexes // windowCount, windowCount + flowIndexes % windowCount))
+        columnIndexes = np.concatenate((flowIndexes, flowIndexes))
+        constraintCache[key] = csr_matrix((np.ones(rowIndexes.size), (rowIndexes, columnIndexes)), shape=(2 * windowCount, windowCount * windowCount))
+
+    return constraintCache[key]
+
+def gridConstraints(width, height):
+    key = (width, height)
+
+    if key not in gridCache:
+        from scipy.sparse import csr_matrix
+
+        verticalSlots = 28 // height
+        horizontalSlots = 28 // width
+        windows = np.arange(verticalSlots * horizontalSlots).reshape(verticalSlots, horizontalSlots)
+
+        # edges between neighboring windows in both directions, a step costs the distance of the centroids
+        sources = np.concatenate((windows[:, :-1].ravel(), windows[:-1, :].ravel()))
+        targets = np.concatenate((windows[:, 1:].ravel(), windows[1:, :].ravel()))
+        steps = np.concatenate((np.full(windows[:, :-1].size, float(width)), np.full(windows[:-1, :].size, float(height))))
+        sources, targets = np.concatenate((sources, targets)), np.concatenate((targets, sources))
+        costs = np.concatenate((steps, steps))
 
-    windowXIndexes = [x for x in range(28 // windowWidth)]
-    windowYIndexes = [y for y in range(28 // windowHeight)]
+        # flow out minus flow in of every window, one column per edge
+        edgeIndexes = np.arange(sources.size)
+        constraints = csr_matrix((np.concatenate((np.ones(sources.size), -np.ones(targets.size))),
+                                  (np.concatenate((sources, targets)), np.concatenate((edgeIndexes, edgeIndexes)))),
+                                 shape=(windows.size, sources.size))
 
-    windowIndex = 0
-    imageSignatures = []
-    otherImageSignatures = []
+        gridCache[key] = (costs, constraints)
 
-    # for every window
-    for windowY in windowYIndexes:
-        for windowX in windowXIndexes:
-            # calculate the actual signatures for current window
-            imageSignature = (windowIndex, calculateBrightness(windowWidth, windowHeight, windowX, windowY, image))
-            otherImageSignature = (windowIndex, calculateBrightness(windowWidth, windowHeight, windowX, windowY, otherImage))
+    return gridCache[key]
 
-            # put them into the lists
-            imageSignatures.append(imageSignature)
-            otherImageSignatures.append(otherImageSignature)
+def gridDistance(width, height, imageSignature, otherImageSignature):
+    from scipy.optimize import linprog, OptimizeResult
 
-            windowIndex += 1
+    # a single window has no edges, both signatures are all of the mass in it
+    if len(imageSignature) == 1:
+        return OptimizeResult(fun=0.0, nit=0, status=0)
 
+    # with the manhattan distance of the centroids as ground distance, moving mass between two windows
+    # costs the same as moving it along any shortest path of the grid, so the flow only needs the
+    # edges between neighbors, about 4 per window instead of one per pair of windows
+    costs, constraints = gridConstraints(width, height)
 
+    return linprog(costs, A_eq=constraints, b_eq=imageSignature - otherImageSignature)
 
-    # now we must normalize such that sum of brightness is the same
-    normalizeBrightness(imageSignatures, otherImageSignatures)
+def manhattanNearestNeighbors(queryImages, otherImages, k, memoryBudget=256 << 20):
+    queryCount = len(queryImages)
+    otherCount = len(otherImages)
+    k = min(k, otherCount)
 
-    # now that they are normalized, we must formulate the linprog input
+    # pixels are bytes, so every distance is an integer and (distance, id) fits in one
+    # int64 key, which keeps the tie-breaking of kNearestNeighbors (lower id first)
+    pixels = int(np.prod(np.shape(otherImages)[1:]))
+    queryBlockSize = max(1, min(queryCount, 32))
+    otherBlockSize = max(1, memoryBudget // (queryBlockSize * pixels * np.dtype(np.int16).itemsize))
 
-    # first identify the function to minimize
-    distances = []
-    for imageSignature in imageSignatures:
-        for otherImageSignature in otherImageSignatures:
-            distances.append(windowDistance(windowWidth, windowHeight, imageSignature[0], otherImageSignature[0]))
-    
-    # now the constraints and bounds
-    constraints = []
-    bounds = []
+    neighbors = np.empty((queryCount, k), dtype=np.int64)
 
-    # now for Fij >= 0
-    windowCount = len(imageSignatures)
+    for queryStart in range(0, queryCount, queryBlockSize):
+        queryBlock = np.asarray(queryImages[queryStart:queryStart + queryBlockSize], dtype=np.int16).reshape(-1, pixels)
+        bestKeys = np.empty((len(queryBlock), 0), dtype=np.int64)
 
-    for index in range(windowCount * windowCount):
-        positiveFlow = ([0] * index) + [-1] + ([0] * (windowCount * windowCount - 1 - index))
-        constraints.append(positiveFlow)
-        bounds.append(0)
+        for otherStart in range(0, otherCount, otherBlockSize):
+            otherBlock = np.asarray(otherImages[otherStart:otherStart + otherBlockSize], dtype=np.int16).reshape(-1, pixels)
 
-    # now sum over j of Fij = wi for every i 
+            # L1 distance of every query of the block to every image of the block
+            distances = np.abs(queryBlock[:, None, :] - otherBlock[None, :, :]).sum(axis=2, dtype=np.int64)
+            keys = distances * otherCount + np.arange(otherStart, otherStart + len(otherBlock))
 
-    for i in range(windowCount):
-        lte1 = ([0] * (i * windowCount)) + ([1] * windowCount) + ([0] * (windowCount - i - 1) * (windowCount))
-        gte1 = ([0] * (i * windowCount)) + ([-1] * windowCount) + ([0] * (windowCount - i - 1) * (windowCount))
+            # keep only the k best keys seen so far
+            candidates = np.concatenate((bestKeys, keys), axis=1)
+            if candidates.shape[1] > k:
+                candidates = np.partition(candidates, k - 1, axis=1)[:, :k]
+            bestKeys = candidates
 
-        lte2 = []
-        gte2 = []
+        neighbors[queryStart:queryStart + len(queryBlock)] = np.sort(bestKeys, axis=1) % otherCount
 
-        for number in range(windowCount * windowCount):
-            if number % windowCount == i:
-                lte2.append(1)
-                gte2.append(-1)
-            else:
-                lte2.append(0)
-                gte2.append(0)
+    return neighbors
 
-        imageW = imageSignatures[i][1]
-        otherImageW = otherImageSignatures[i][1]
+def earthMoverDistance(inputWidth, inputHeight, image, otherImage, solver='linprog'):
+    # calculate the normalized signatures of both images in one go
+    imageSignature, otherImageSignature = computeSignatures(np.stack((image, otherImage)), inputWidth, inputHeight)
 
-        constraints.append(lte1)
-        bounds.append(imageW)
+    return signatureDistance(inputWidth, inputHeight, imageSignature, otherImageSignature, solver)
 
-        constraints.append(gte1)
-        bounds.append(-imageW)
+def signatureDistance(windowWidth, windowHeight, imageSignature, otherImageSignature, solver='linprog'):
+    if profiler is not None:
+        return profiledSignatureDistance(windowWidth, windowHeight, imageSignature, otherImageSignature, solver)
 
-        constraints.append(lte2)
-        bounds.append(otherImageW)
+    if solver == 'grid':
+        return gridDistance(windowWidth, windowHeight, imageSignature, otherImageSignature).fun
 
-        constraints.append(gte2)
-        bounds.append(-otherImageW)
+    # since signatures are normalized, we only need the right hand side of the problem,
+    # the costs and the constraint matrix depend on the window geometry alone
+    costs, _ = windowGeometry(windowWidth, windowHeight)
 
-    res = linprog(distances, A_ub=constraints, b_ub=bounds)
+    # the balanced transportation problem can be solved directly on the signatures, always from
+    # the same initial basis: a basis left over from another pair may end in a different optimal
+    # vertex whose cost differs in the last bits, and the searches compare distances exactly
+    if solver == 'transport':
+        distance, _, _ = transportationSimplex(costs, imageSignature, otherImageSignature)
+
+        return distance
+
+    from scipy.optimize import linprog
+
+    # Fij >= 0 is the default variable bound of linprog
+    res = linprog(costs.ravel(), A_eq=windowConstraints(windowWidth, windowHeight), b_eq=np.concatenate((imageSignature, otherImageSignature)))
     return res.fun
 
-def normalizeBrightness(imageSignatures, otherImageSignatures):
-    goalBrightness = 1
+def profiledSignatureDistance(windowWidth, windowHeight, imageSignature, otherImageSignature, solver):
+    # same as signatureDistance, with every stage timed
+    setupStart = time.perf_counter()
+    if solver == 'grid':
+        gridConstraints(windowWidth, windowHeight)
+    else:
+        costs, _ = windowGeometry(windowWidth, windowHeight)
+    if solver == 'linprog':
+        constraints = windowConstraints(windowWidth, windowHeight)
+        rightHandSide = np.concatenate((imageSignature, otherImageSignature))
+    solveStart = time.perf_counter()
+    profiler.add("setup", solveStart - setupStart)
+
+    if solver == 'transport':
+        distance, _, iterations = transportationSimplex(costs, imageSignature, otherImageSignature)
+        status = 0
+    elif solver == 'grid':
+        res = gridDistance(windowWidth, windowHeight, imageSignature, otherImageSignature)
+        distance, iterations, status = res.fun, res.nit, res.status
+    else:
+        from scipy.optimize import linprog
+        res = linprog(costs.ravel(), A_eq=constraints, b_eq=rightHandSide)
+        distance, iterations, status = res.fun, res.nit, res.status
+
+    profiler.add("solve", time.perf_counter() - solveStart)
+    profiler.addSolve(iterations, status)
+
+    return distance
+
+def computeSignatures(images, width, height):
+    verticalSlots = 28 // height
+    horizontalSlots = 28 // width
+
+    # view every image as 28 rows of 28 pixels and drop the pixels that do not fit in a whole window
+    images = np.asarray(images).reshape(-1, 28, 28)[:, :verticalSlots * height, :horizontalSlots * width]
+
+    # sum the brightness of every window, windows are numbered row by row
+    windows = images.reshape(-1, verticalSlots, height, horizontalSlots, width)
+    signatures = windows.sum(axis=(2, 4), dtype=np.float64).reshape(-1, verticalSlots * horizontalSlots)
+
+    # every window gets one extra unit of brightness so that no signature is empty
+    signatures += 1
+
+    # now we must normalize such that sum of brightness is the same for every image
+    signatures /= signatures.sum(axis=1, keepdims=True)
+
+    return signatures
+
+def loadSignatures(storePath, imagesPath, width, height):
+    # stored signatures are keyed by dataset name, window geometry and dataset contents
+    prefix = os.path.join(storePath, os.path.basename(imagesPath) + "-" + str(width) + "x" + str(height) + "-")
+    signaturesPath = prefix + fileHash(imagesPath)[:16] + ".npy"
+
+    if os.path.exists(signaturesPath):
+        return np.load(signaturesPath, mmap_mode='r')
+
+    signatures = computeSignatures(openImages(imagesPath), width, height)
+
+    # the dataset changed (or is new), so stored signatures of older versions are stale
+    os.makedirs(storePath, exist_ok=True)
+    for stalePath in glob.glob(glob.escape(prefix) + "*.npy"):
+        os.remove(stalePath)
+
+    # write to a temporary file first so that concurrent runs never see half a store
+    temporaryPath = signaturesPath + "." + str(os.getpid()) + ".tmp"
+    with open(temporaryPath, mode='wb') as binaryFile:
+        np.save(binaryFile, signatures)
+    os.replace(temporaryPath, signaturesPath)
+
+    return np.load(signaturesPath, mmap_mode='r')
+
+def signatureLowerBounds(querySignature, otherSignatures, width, height, solver=None):
+    verticalSlots = 28 // height
+    horizontalSlots = 28 // width
+    centroids = windowCentroids(width, height)
+
+    otherSignatures = np.asarray(otherSignatures)
+    differences = (otherSignatures - querySignature).reshape(-1, verticalSlots, horizontalSlots)
+
+    # moving the mass can never cost less than moving its centroid
+    centroidBound = np.sqrt(np.sum((differences.reshape(len(differences), -1) @ centroids) ** 2, axis=1))
+
+    # nor less than the emd of its projection on either axis, which in one dimension
+    # is the area between the cumulative distributions
+    horizontalBound = width * np.abs(np.cumsum(differences.sum(axis=1), axis=1)[:, :-1]).sum(axis=1)
+    verticalBound = height * np.abs(np.cumsum(differences.sum(axis=2), axis=1)[:, :-1]).sum(axis=1)
+
+    # the manhattan ground distance of the grid solver pays both axes, so their bounds add up
+    if solver == 'grid':
+        return np.maximum(centroidBound, horizontalBound + verticalBound)
+
+    return np.maximum(centroidBound, np.maximum(horizontalBound, verticalBound))
+
+# bounds are compared against solver results, leave room for their rounding
+PRUNE_TOLERANCE = 1e-9
+
+def prunedNearestNeighbors(querySignature, otherSignatures, k, width, height, solver):
+    if profiler is not None:
+        boundsStart = time.perf_counter()
+    bounds = signatureLowerBounds(querySignature, otherSignatures, width, height, solver)
+    if profiler is not None:
+        profiler.add("bounds", time.perf_counter() - boundsStart)
 
-    # calculate total brightnesses
-    imageBrightness = sum([brightness for (_, brightness) in imageSignatures])
-    otherImageBrightness = sum([brightness for (_, brightness) in otherImageSignatures])
+    neighborsWithDistances = []
+    solves = 0
 
-    scalingFactor = goalBrightness / otherImageBrightness
-    newOtherImageSignatures = [(index, brightness * scalingFactor) for (index, brightness) in otherImageSignatures]
-    otherImageSignatures.clear()
-    otherImageSignatures.extend(newOtherImageSignatures)
+    # visit candidates from the lowest bound up, ties by id as in kNearestNeighbors
+    for currId in np.argsort(bounds, kind='stable'):
+        currId = int(currId)
 
-    scalingFactor = goalBrightness / imageBrightness
-    newImageSignatures = [(index, brightness * scalingFactor) for (index, brightness) in imageSignatures]
-    imageSignatures.clear()
-    imageSignatures.extend(newImageSignatures)
+        # every remaining candidate is at least as far as its bound, so none can enter
+        if len(neighborsWithDistances) == k and bounds[currId] > neighborsWithDistances[k - 1][0] + PRUNE_TOLERANCE:
+            break
 
+        candidate = (signatureDistance(width, height, querySignature, otherSignatures[currId], solver), currId)
+        solves += 1
 
+        # candidates do not come in id order, so compare (distance, id) pairs
+        if len(neighborsWithDistances) < k:
+            bisect.insort(neighborsWithDistances, candidate)
+        elif candidate < neighborsWithDistances[k - 1]:
+            neighborsWithDistances.pop()
+            bisect.insort(neighborsWithDistances, candidate)
+
+    return [neighborId for (_, neighborId) in neighborsWithDistances], solves
+
+# gibbs kernels of the ground distance per window geometry and regularization
+kernelCache = {}
+# marginal error at which sinkhorn iterations stop early
+SINKHORN_TOLERANCE = 1e-9
+# memory for the plans of one block of candidates in the log domain
+SINKHORN_LOG_MEMORY = 64 << 20
+
+def sinkhornDistances(querySignature, otherSignatures, width, height, regularization, iterations):
+    costs, _ = windowGeometry(width, height)
+
+    key = (width, height, regularization)
+    if key not in kernelCache:
+        kernel = np.exp(-costs / regularization)
+        kernelCache[key] = (kernel, kernel * costs)
+    kernel, weightedKernel = kernelCache[key]
+
+    otherSignatures = np.asarray(otherSignatures)
+
+    # scale rows and columns of the kernel of every pair at once until both marginals match,
+    # u and v hold one scaling vector per candidate
+    u = np.ones_like(otherSignatures)
+    v = np.ones_like(otherSignatures)
+    # overflowing scalings are expected with small regularizations, they are caught below
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        for _ in range(iterations):
+            u = querySignature / (v @ kernel.T)
+            v = otherSignatures / (u @ kernel)
+
+            # the column marginals are exact after the v update, stop once the rows are too
+            if np.abs(u * (v @ kernel.T) - querySignature).sum(axis=1).max() < SINKHORN_TOLERANCE:
+                break
+
+        # transport cost of the plan diag(u) K diag(v) of every candidate
+        distances = np.sum((u @ weightedKernel) * v, axis=1)
+
+    # with a small regularization the kernel underflows and the scalings end in 0 / 0 or overflow,
+    # those candidates are solved again with potentials in the log domain, which cannot underflow
+    unstable = ~(np.isfinite(distances) & np.isfinite(u).all(axis=1) & np.isfinite(v).all(axis=1) & (u > 0).all(axis=1) & (v > 0).all(axis=1))
+    if unstable.any():
+        distances[unstable] = logSinkhornDistances(querySignature, otherSignatures[unstable], costs, regularization, iterations)
+
+    if not np.isfinite(distances).all():
+        raise ValueError("sinkhorn distances are not finite, regularization " + str(regularization) + " is too small")
+
+    return distances
+
+def logSumExp(values, axis):
+    largest = values.max(axis=axis, keepdims=True)
+
+    return np.squeeze(largest, axis=axis) + np.log(np.exp(values - largest).sum(axis=axis))
+
+def logSinkhornDistances(querySignature, otherSignatures, costs, regularization, iterations):
+    windowCount = len(costs)
+    distances = np.empty(len(otherSignatures))
+
+    # the log domain needs a windowCount x windowCount block per candidate, so candidates go in blocks
+    blockSize = max(1, SINKHORN_LOG_MEMORY // (windowCount * windowCount * np.dtype(np.float64).itemsize))
+    for start in range(0, len(otherSignatures), blockSize):
+        logOther = np.log(otherSignatures[start:start + blockSize])
+        logQuery = np.log(querySignature)
+
+        # f and g are regularization * log of u and v, the plan is exp((f_i + g_j - Cij) / regularization)
+        f = np.zeros_like(logOther)
+        g = np.zeros_like(logOther)
+        for _ in range(iterations):
+            f = regularization * (logQuery - logSumExp((g[:, None, :] - costs[None, :, :]) / regularization, axis=2))
+            g = regularization * (logOther - logSumExp((f[:, :, None] - costs[None, :, :]) / regularization, axis=1))
+
+            plan = np.exp((f[:, :, None] + g[:, None, :] - costs[None, :, :]) / regularization)
+            if np.abs(plan.sum(axis=2) - querySignature).sum(axis=1).max() < SINKHORN_TOLERANCE:
+                break
+
+        distances[start:start + blockSize] = np.sum(plan * costs, axis=(1, 2))
+
+    return distances
+
+def sinkhornNearestNeighbors(querySignature, otherSignatures, k, width, height, regularization, iterations):
+    distances = sinkhornDistances(querySignature, otherSignatures, width, height, regularization, iterations)
+
+    # stable sort keeps ties in id order as in kNearestNeighbors
+    return [int(neighborId) for neighborId in np.argsort(distances, kind='stable')[:k]]
+
+def nearestNeighbors(queryImages, querySignatures, inputImages, inputSignatures, settings):
+    width = settings["width"]
+    height = settings["height"]
+    solver = settings["solver"]
+
+    # find 10 nearest neighbors with manhattan distance metric for all queries at once
+    manhattanStart = time.perf_counter()
+    manhattanNeighbors = manhattanNearestNeighbors(queryImages, inputImages, 10, settings["memoryBudget"])
+    if profiler is not None:
+        profiler.add("manhattan", time.perf_counter() - manhattanStart)
+
+    # find 10 nearest neighbors with emd distance metric for every query
+    emdNeighbors = []
+    emdSolves = []
+    emdSeconds = []
+    for querySignature in querySignatures:
+        queryStart = time.perf_counter()
+
+        if settings["mode"] == "sinkhorn":
+            neighbors, solves = sinkhornNearestNeighbors(querySignature, inputSignatures, 10, width, height, settings["regularization"], settings["iterations"]), 0
+        elif settings["search"] == "prune":
+            neighbors, solves = prunedNearestNeighbors(querySignature, inputSignatures, 10, width, height, solver)
+        else:
+            neighbors, solves = kNearestNeighbors(querySignature, inputSignatures, 10, partial(signatureDistance, width, height, solver=solver)), len(inputSignatures)
+
+        emdNeighbors.append(neighbors)
+        emdSolves.append(solves)
+        emdSeconds.append(time.perf_counter() - queryStart)
+        if profiler is not None:
+            profiler.add("emd_search", emdSeconds[-1])
+
+    return emdNeighbors, manhattanNeighbors, emdSolves, emdSeconds
+
+# arrays and settings of a worker process, attached once by initializeWorker
+workerState = {}
+
+def shareArray(array):
+    array = np.ascontiguousarray(array)
+
+    # copy the array into shared memory once, workers attach to it by name instead of unpickling it
+    sharedMemory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=sharedMemory.buf)[...] = array
+
+    return sharedMemory, (sharedMemory.name, array.shape, array.dtype.str)
 
-def calculateBrightness(width, height, i, j, image):
-    brightness = 0
+def initializeWorker(sharedArrays, settings):
+    for name, (memoryName, shape, dtype) in sharedArrays.items():
+        sharedMemory = shared_memory.SharedMemory(name=memoryName)
 
-    for y in range(height * j, height * (j + 1)):
-        for x in range(width * i, width * (i + 1)):
-            brightness += image[y * width + x]
+        # keep the handle alive for as long as the array is used
+        workerState[name + "Memory"] = sharedMemory
+        workerState[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=sharedMemory.buf)
+
+    workerState["settings"] = settings
+
+def searchQueries(queryRange):
+    global profiler
+    queryStart, queryStop = queryRange
+
+    # every chunk reports its own stage timings, the parent merges them
+    if workerState["settings"].get("profile"):
+        profiler = Profiler()
+
+    results = nearestNeighbors(workerState["queryImages"][queryStart:queryStop],
+                               workerState["querySignatures"][queryStart:queryStop],
+                               workerState["inputImages"],
+                               workerState["inputSignatures"],
+                               workerState["settings"])
 
-    return brightness + 1
+    return results, profiler
 
+def parallelNearestNeighbors(queryImages, querySignatures, inputImages, inputSignatures, settings, workers):
+    arrays = {"queryImages": queryImages, "querySignatures": querySignatures, "inputImages": inputImages, "inputSignatures": inputSignatures}
+
+    # a few contiguous chunks of queries per worker keeps the pool balanced
+    queryCount = len(queryImages)
+    chunkSize = max(1, math.ceil(queryCount / (workers * 4)))
+    queryRanges = [(queryStart, min(queryCount, queryStart + chunkSize)) for queryStart in range(0, queryCount, chunkSize)]
+
+    sharedMemories = []
+    try:
+        sharedArrays = {}
+        for name, array in arrays.items():
+            sharedMemory, description = shareArray(array)
+            sharedMemories.append(sharedMemory)
+            sharedArrays[name] = description
+
+        workerSettings = dict(settings, profile=profiler is not None)
+        with Pool(workers, initializer=initializeWorker, initargs=(sharedArrays, workerSettings)) as pool:
+            # map returns the chunks in query order, so merging is deterministic
+            chunkResults = pool.map(searchQueries, queryRanges)
+    finally:
+        for sharedMemory in sharedMemories:
+            sharedMemory.close()
+            sharedMemory.unlink()
+
+    results = [chunkResult for (chunkResult, _) in chunkResults]
+    if profiler is not None:
+        for (_, chunkProfiler) in chunkResults:
+            profiler.merge(chunkProfiler)
+
+    emdNeighbors = [neighbors for (chunkNeighbors, _, _, _) in results for neighbors in chunkNeighbors]
+    manhattanNeighbors = np.concatenate([chunkNeighbors for (_, chunkNeighbors, _, _) in results])
+    emdSolves = [solves for (_, _, chunkSolves, _) in results for solves in chunkSolves]
+    emdSeconds = [seconds for (_, _, _, chunkSeconds) in results for seconds in chunkSeconds]
+
+    return emdNeighbors, manhattanNeighbors, emdSolves, emdSeconds
+
+def matrixTiles(rowCount, columnCount, tileSize, symmetric):
+    tiles = []
+    for rowStart in range(0, rowCount, tileSize):
+        for columnStart in range(0, columnCount, tileSize):
+            # the lower triangle of a symmetric matrix is mirrored from the upper one
+            if symmetric and columnStart < rowStart:
+                continue
+            tiles.append((rowStart, min(rowCount, rowStart + tileSize), columnStart, min(columnCount, columnStart + tileSize)))
+
+    return tiles
+
+def tileDistances(rowSignatures, columnSignatures, tile, settings):
+    width = settings["width"]
+    height = settings["height"]
+    rowStart, rowStop, columnStart, columnStop = tile
+
+    distances = np.empty((rowStop - rowStart, columnStop - columnStart))
+    for rowIndex in range(rowStart, rowStop):
+        if settings["mode"] == "sinkhorn":
+            distances[rowIndex - rowStart] = sinkhornDistances(rowSignatures[rowIndex], columnSignatures[columnStart:columnStop], width, height, settings["regularization"], settings["iterations"])
+            continue
+
+        for columnIndex in range(columnStart, columnStop):
+            distances[rowIndex - rowStart, columnIndex - columnStart] = signatureDistance(width, height, rowSignatures[rowIndex], columnSignatures[columnIndex], settings["solver"])
+
+    return distances
+
+def computeTile(tile):
+    global profiler
+
+    # like searchQueries, every tile reports its own stage timings and the parent merges them
+    if workerState["settings"].get("profile"):
+        profiler = Profiler()
+
+    return tile, tileDistances(workerState["rowSignatures"], workerState["columnSignatures"], tile, workerState["settings"]), profiler
+
+def openMatrix(matrixPath, rowCount, columnCount, tileSize, description):
+    description = dict(description, rows=rowCount, columns=columnCount, tile=tileSize)
+    donePath = matrixPath + ".done.npy"
+    descriptionPath = matrixPath + ".json"
+
+    # resume a matrix only if it was started on the same data with the same settings
+    if os.path.exists(descriptionPath):
+        with open(descriptionPath) as descriptionFile:
+            if json.load(descriptionFile) != description:
+                raise ValueError(matrixPath + ": matrix was started with different data or settings, remove it to start over")
+
+        return np.load(matrixPath, mmap_mode='r+'), np.load(donePath, mmap_mode='r+')
+
+    matrix = np.lib.format.open_memmap(matrixPath, mode='w+', dtype=np.float64, shape=(rowCount, columnCount))
+    done = np.lib.format.open_memmap(donePath, mode='w+', dtype=np.bool_, shape=(math.ceil(rowCount / tileSize), math.ceil(columnCount / tileSize)))
+    matrix.flush()
+    done.flush()
+
+    # the description is written last, so a matrix without one is simply started over
+    with open(descriptionPath, mode='w') as descriptionFile:
+        json.dump(description, descriptionFile)
+
+    return matrix, done
+
+def storeTile(matrix, done, tile, distances, tileSize, symmetric):
+    rowStart, rowStop, columnStart, columnStop = tile
+
+    matrix[rowStart:rowStop, columnStart:columnStop] = distances
+    if symmetric:
+        matrix[columnStart:columnStop, rowStart:rowStop] = distances.T
+
+    # the tile only counts as done once its distances are on disk
+    matrix.flush()
+    done[rowStart // tileSize, columnStart // tileSize] = True
+    if symmetric:
+        done[columnStart // tileSize, rowStart // tileSize] = True
+    done.flush()
+
+def computeMatrix(matrixPath, rowSignatures, columnSignatures, settings, description, tileSize, workers=1, symmetric=False):
+    matrix, done = openMatrix(matrixPath, len(rowSignatures), len(columnSignatures), tileSize, description)
+
+    # tiles finished by an earlier run are skipped
+    tiles = [tile for tile in matrixTiles(len(rowSignatures), len(columnSignatures), tileSize, symmetric)
+             if not done[tile[0] // tileSize, tile[2] // tileSize]]
+
+    if workers > 1 and len(tiles) > 1:
+        sharedMemories = []
+        try:
+            sharedArrays = {}
+            for name, array in (("rowSignatures", rowSignatures), ("columnSignatures", columnSignatures)):
+                sharedMemory, sharedArray = shareArray(array)
+                sharedMemories.append(sharedMemory)
+                sharedArrays[name] = sharedArray
+
+            workerSettings = dict(settings, profile=profiler is not None)
+            with Pool(workers, initializer=initializeWorker, initargs=(sharedArrays, workerSettings)) as pool:
+                # tiles are stored as soon as any worker finishes one, in whatever order
+                for tile, distances, tileProfiler in pool.imap_unordered(computeTile, tiles):
+                    storeTile(matrix, done, tile, distances, tileSize, symmetric)
+                    if profiler is not None:
+                        profiler.merge(tileProfiler)
+        finally:
+            for sharedMemory in sharedMemories:
+                sharedMemory.close()
+                sharedMemory.unlink()
+    else:
+        for tile in tiles:
+            storeTile(matrix, done, tile, tileDistances(rowSignatures, columnSignatures, tile, settings), tileSize, symmetric)
+
+    return matrix
+
+def matrixNearestNeighbors(matrix, k, excludeSelf=False, memoryBudget=256 << 20):
+    rowCount, columnCount = matrix.shape
+    k = min(k, columnCount - excludeSelf)
+
+    # read as many rows at once as the memory budget allows
+    rowBlockSize = max(1, memoryBudget // (columnCount * matrix.dtype.itemsize))
+    neighbors = np.empty((rowCount, k), dtype=np.int64)
+
+    for rowStart in range(0, rowCount, rowBlockSize):
+        distances = np.array(matrix[rowStart:rowStart + rowBlockSize])
+
+        # an image is not its own neighbor when the matrix compares a set with itself
+        if excludeSelf:
+            rowIndexes = np.arange(len(distances))
+            distances[rowIndexes, rowStart + rowIndexes] = np.inf
+
+        # a stable sort keeps the tie-breaking of kNearestNeighbors (lower id first)
+        neighbors[rowStart:rowStart + len(distances)] = np.argsort(distances, axis=1, kind='stable')[:, :k]
+
+    return neighbors
+
+def withoutSelf(neighbors):
+    # drop every image from its own neighbors, or the farthest neighbor if it is not there
+    isSelf = neighbors == np.arange(len(neighbors))[:, None]
+    keep = ~isSelf
+    keep[~isSelf.any(axis=1), -1] = False
+
+    return neighbors[keep].reshape(len(neighbors), -1)
+
+def matrixEvaluation(inputImages, inputLabels, queryImages, queryLabels, settings, matrixPath, k, tileSize, inputSignatures=None, workers=1, symmetric=False):
+    evaluationStart = time.perf_counter()
+
+    if inputSignatures is None:
+        inputSignatures = computeSignatures(inputImages, settings["width"], settings["height"])
+    querySignatures = inputSignatures if symmetric else computeSignatures(queryImages, settings["width"], settings["height"])
+
+    # everything a cached distance depends on, transport and linprog give the same distances,
+    # the grid solver moves mass along the grid and so measures it with the manhattan distance
+    groundDistance = "manhattan" if settings["mode"] == "exact" and settings["solver"] == "grid" else "euclidean"
+    description = {"width": settings["width"], "height": settings["height"], "mode": settings["mode"], "groundDistance": groundDistance, "symmetric": symmetric,
+                   "rowsHash": hashlib.sha256(np.ascontiguousarray(querySignatures)).hexdigest(),
+                   "columnsHash": hashlib.sha256(np.ascontiguousarray(inputSignatures)).hexdigest()}
+    if settings["mode"] == "sinkhorn":
+        description.update(regularization=settings["regularization"], iterations=settings["iterations"])
+
+    matrix = computeMatrix(matrixPath, querySignatures, inputSignatures, settings, description, tileSize, workers, symmetric)
+
+    # with the matrix on disk, any k is just a sort away
+    emdNeighbors = matrixNearestNeighbors(matrix, k, symmetric, settings["memoryBudget"])
+    manhattanNeighbors = manhattanNearestNeighbors(queryImages, inputImages, k + symmetric, settings["memoryBudget"])
+    if symmetric:
+        manhattanNeighbors = withoutSelf(manhattanNeighbors)
+
+    return {"emdCorrectness": totalCorrectness(emdNeighbors, queryLabels, inputLabels, k),
+            "manhattanCorrectness": totalCorrectness(manhattanNeighbors, queryLabels, inputLabels, k),
+            "emdNeighbors": emdNeighbors,
+            "manhattanNeighbors": manhattanNeighbors,
+            "wallTime": time.perf_counter() - evaluationStart}
+
+def totalCorrectness(neighbors, queryLabels, inputLabels, k=10):
+    totalCorrectness = 0
+
+    # for every query image
+    for queryIndex in range(len(neighbors)):
+        queryClass = queryLabels[queryIndex]
+        correctGuesses = 0
+
+        # for every neighbor, see if it is in the correct class
+        for neighborId in neighbors[queryIndex]:
+            if queryClass == inputLabels[neighborId]:
+                correctGuesses += 1
+
+        totalCorrectness += correctGuesses / k
+
+    return totalCorrectness
+
+def evaluate(inputImages, inputLabels, queryImages, queryLabels, settings, inputSignatures=None, workers=1):
+    evaluationStart = time.perf_counter()
+
+    # calculate the signatures of every image once, unless the input ones were loaded from a store
+    signaturesStart = time.perf_counter()
+    if inputSignatures is None:
+        inputSignatures = computeSignatures(inputImages, settings["width"], settings["height"])
+    querySignatures = computeSignatures(queryImages, settings["width"], settings["height"])
+    if profiler is not None:
+        profiler.add("signatures", time.perf_counter() - signaturesStart)
+
+    # search the neighbors of every query, split across processes if asked to
+    if workers > 1:
+        emdNeighbors, manhattanNeighbors, emdSolves, emdSeconds = parallelNearestNeighbors(queryImages, querySignatures, inputImages, inputSignatures, settings, workers)
+    else:
+        emdNeighbors, manhattanNeighbors, emdSolves, emdSeconds = nearestNeighbors(queryImages, querySignatures, inputImages, inputSignatures, settings)
+
+    return {"emdCorrectness": totalCorrectness(emdNeighbors, queryLabels, inputLabels),
+            "manhattanCorrectness": totalCorrectness(manhattanNeighbors, queryLabels, inputLabels),
+            "emdNeighbors": emdNeighbors,
+            "manhattanNeighbors": manhattanNeighbors,
+            "emdSolves": emdSolves,
+            "emdSeconds": emdSeconds,
+            "inputSignatures": inputSignatures,
+            "querySignatures": querySignatures,
+            "wallTime": time.perf_counter() - evaluationStart}
+
+def writeProfile(outputPath, queryLatencies, wallTime):
+    # the profile report goes next to the accuracy output
+    report = profiler.report(queryLatencies)
+    report["wallTime"] = wallTime
+    with open(outputPath + ".profile.json", mode='w') as reportFile:
+        json.dump(report, reportFile, indent=2)
+
+
+def main(argv=None):
+    global profiler
 
-def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d')
     parser.add_argument('-q')
@@ -214,9 +813,24 @@ def main():
     parser.add_argument('-o')
     parser.add_argument('-width', default="7")
     parser.add_argument('-height', default="7")
-
-
-    args = parser.parse_args()
+    parser.add_argument('-solver', default="transport", choices=["transport", "linprog", "grid"])
+    parser.add_argument('-store')
+    parser.add_argument('-prebuild', action='store_true')
+    parser.add_argument('-memory', default="256")
+    parser.add_argument('-workers', default="1")
+    parser.add_argument('-search', default="prune", choices=["prune", "exhaustive"])
+    parser.add_argument('-emd-mode', default="exact", choices=["exact", "sinkhorn"])
+    parser.add_argument('-reg', default="1.0")
+    parser.add_argument('-sinkhorn-iters', default="200")
+    parser.add_argument('-agreement', default="0")
+    parser.add_argument('-profile', action='store_true')
+    parser.add_argument('-matrix')
+    parser.add_argument('-matrix-pairs', default="query", choices=["query", "train"])
+    parser.add_argument('-tile', default="64")
+    parser.add_argument('-k', default="10")
+
+
+    args = parser.parse_args(argv)
 
     inputFilePath = args.d
     queryFilePath = args.q
@@ -225,50 +839,88 @@ def main():
     outputPath = args.o
     inputWidth = int(args.width)
     inputHeight = int(args.height)
-
-    # read images
-    inputImages = readImages(inputFilePath)
-    queryImages = readImages(queryFilePath)
-
-    # read labels
+    solver = args.solver
+    storePath = args.store
+    memoryBudget = int(args.memory) << 20
+    workers = int(args.workers)
+    agreementQueries = int(args.agreement)
+    settings = {"width": inputWidth, "height": inputHeight, "solver": solver, "search": args.search, "memoryBudget": memoryBudget,
+                "mode": args.emd_mode, "regularization": float(args.reg), "iterations": int(args.sinkhorn_iters)}
+
+    if args.profile:
+        profiler = Profiler()
+
+    # only build the signature store of the input set and exit
+    if args.prebuild:
+        if storePath is None:
+            parser.error("-prebuild requires -store")
+        loadSignatures(storePath, inputFilePath, inputWidth, inputHeight)
+        return
+
+    # map images, one flat row of bytes per image
+    inputImages = openImages(inputFilePath)
+    inputImages = inputImages.reshape(len(inputImages), -1)
     inputLabels = readLabels(inputLabelsPath)
-    queryLabels = readLabels(queryLabelsPath)
 
-    queryIndex = 0
-
-    totalEmdCorrectness = 0
-    totalManhattanCorrectness = 0
-
-    # for every query image
-    for queryImage in queryImages:
-        queryClass = queryLabels[queryIndex]
-        emdCorrectGuesses = 0
-        manhattanCorrectGuesses = 0
+    # the train x train matrix compares the input set with itself
+    symmetric = args.matrix is not None and args.matrix_pairs == "train"
+    if symmetric:
+        queryImages = inputImages
+        queryLabels = inputLabels
+    else:
+        queryImages = openImages(queryFilePath)
+        queryImages = queryImages.reshape(len(queryImages), -1)
+        queryLabels = readLabels(queryLabelsPath)
+
+    # the signatures of the input set can come from the store
+    inputSignatures = None
+    if storePath is not None:
+        storeStart = time.perf_counter()
+        inputSignatures = loadSignatures(storePath, inputFilePath, inputWidth, inputHeight)
+        if profiler is not None:
+            profiler.add("signature_store", time.perf_counter() - storeStart)
+
+    # compute (or resume) the whole distance matrix and answer kNN from it
+    if args.matrix is not None:
+        results = matrixEvaluation(inputImages, inputLabels, queryImages, queryLabels, settings, args.matrix, int(args.k), int(args.tile), inputSignatures, workers, symmetric)
+
+        with open(outputPath, 'w') as outputFile:
+            outputFile.write("Average Correct Search Results EMD: " + str(results["emdCorrectness"]) + "\n")
+            outputFile.write("Average Correct Search Results Manhattan: " + str(results["manhattanCorrectness"]) + "\n")
+
+        # the matrix has no per query searches, only the solver stages are reported
+        if profiler is not None:
+            writeProfile(outputPath, [], results["wallTime"])
+        return
+
+    results = evaluate(inputImages, inputLabels, queryImages, queryLabels, settings, inputSignatures, workers)
+    inputSignatures = results["inputSignatures"]
+    querySignatures = results["querySignatures"]
+    emdNeighbors = results["emdNeighbors"]
+    emdSolves = results["emdSolves"]
 
+    outputFile = open(outputPath, 'w') 
+    outputFile.write("Average Correct Search Results EMD: " + str(results["emdCorrectness"]) + "\n")
+    outputFile.write("Average Correct Search Results Manhattan: " + str(results["manhattanCorrectness"]) + "\n")
 
-        # find 10 nearest neighbors with manhattan distance metric
-        emdNearest = kNearestNeighbors(queryImage, inputImages, 10, partial(earthMoverDistance, inputWidth, inputHeight))
-        manhattanNearest = kNearestNeighbors(queryImage, inputImages, 10, manhattanDistance)
-
-        # for every neighbor, see if it is in the correct class
-        for neighborId in emdNearest:
-            if queryClass == inputLabels[neighborId]:
-                emdCorrectGuesses += 1
-
-        for neighborId in manhattanNearest:
-            if queryClass == inputLabels[neighborId]:
-                manhattanCorrectGuesses += 1
-
-        totalEmdCorrectness += emdCorrectGuesses / 10
-        totalManhattanCorrectness += manhattanCorrectGuesses / 10
+    if settings["mode"] == "exact" and settings["search"] == "prune":
+        # fraction of emd solves skipped thanks to the lower bounds, per query
+        pruneRates = [1 - solves / len(inputSignatures) for solves in emdSolves]
+        outputFile.write("Average EMD Prune Rate: " + str(sum(pruneRates) / len(pruneRates)) + "\n")
+        outputFile.write("EMD Prune Rate Per Query: [" + ", ".join([str(pruneRate) for pruneRate in pruneRates]) + "]\n")
 
+    if settings["mode"] == "sinkhorn" and agreementQueries > 0:
+        # compare the approximate neighbors of the first queries with the exact ones
+        exactSettings = dict(settings, mode="exact", search="prune")
+        exactNeighbors, _, _, _ = nearestNeighbors(queryImages[:agreementQueries], querySignatures[:agreementQueries], inputImages, inputSignatures, exactSettings)
 
-        queryIndex += 1
+        agreements = [len(set(exact) & set(approximate)) / 10 for (exact, approximate) in zip(exactNeighbors, emdNeighbors)]
+        outputFile.write("Average Sinkhorn Agreement With Exact EMD: " + str(sum(agreements) / len(agreements)) + "\n")
 
+    outputFile.close()
 
-    outputFile = open(outputPath, 'w') 
-    outputFile.write("Average Correct Search Results EMD: " + str(totalEmdCorrectness) + "\n")
-    outputFile.write("Average Correct Search Results Manhattan: " + str(totalManhattanCorrectness) + "\n")
+    if profiler is not None:
+        writeProfile(outputPath, results["emdSeconds"], results["wallTime"])
 
 
 
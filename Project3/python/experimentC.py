@@ -1,55 +1,46 @@
-from os import sched_get_priority_min
-from subprocess import call
-import re
+import argparse
 import matplotlib.pyplot as plt
 import numpy as np
 
-from timeit import default_timer as timer
+from sweep import runSweep, writeResults, readResults
 
-def main():
-    X = [28, 14, 7]
-    Y = [28, 14, 7]
-    Z = []
-    T = []
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-results')
+    parser.add_argument('-workers', default="1")
+    parser.add_argument('-solver', default="transport", choices=["transport", "linprog", "grid"])
+    args = parser.parse_args(argv)
 
-    # try out all combinations of width/height in [28, 14, 7]
-    for width in X:
-        currZ = []
-        currT = []
-        for height in Y:
-            start = timer()
-            # run emd.py and collect results
-            call(["python3", "./emd.py", 
-                  "-d", "../originalSpace/verySmallData",
-                  "-q", "../originalSpace/tinyData",
-                  "-l1", "../originalSpace/verySmallLabels",
-                  "-l2", "../originalSpace/tinyLabels",
-                  "-o", "./temp",
-                  "-width", str(width),
-                  "-height", str(height)])
-            end = timer()
+    # the finer windows are only practical with the grid solver, its memory grows with the windows, not their square,
+    # but its ground distance is manhattan, so it is a series of its own next to the euclidean one of emd.py
+    X = [28, 14, 7, 4, 2] if args.solver == "grid" else [28, 14, 7]
+    Y = list(X)
 
-            # collect output from file and store into directory
-            outputFile = open("./temp", "r")
-            lines = outputFile.readlines()
-            # get results
-            emdString = lines[0][re.search(r"\d", lines[0]).start():]
-            manhattanString = lines[1][re.search(r"\d", lines[1]).start():]
+    if args.results is not None:
+        # plot a sweep that was already run, on the geometries it has
+        results = readResults(args.results)
+        X = sorted({result["width"] for result in results}, reverse=True)
+        Y = sorted({result["height"] for result in results}, reverse=True)
+    else:
+        # try out all combinations of width/height in this process
+        settings = {"solver": args.solver, "search": "prune", "memoryBudget": 256 << 20,
+                    "mode": "exact", "regularization": 1.0, "iterations": 200}
+        results = runSweep("../originalSpace/verySmallData",
+                           "../originalSpace/tinyData",
+                           "../originalSpace/verySmallLabels",
+                           "../originalSpace/tinyLabels",
+                           X, Y, settings, "./signatures", int(args.workers))
+        writeResults("./sweep.csv" if args.solver == "transport" else "./sweep-" + args.solver + ".csv", results)
 
-            # since manhattan is consistent, keep the ratio instead
-            emdCorrectness = float(emdString)
-            manhattanCorrectness = float(manhattanString)
-            emdToManhattanRatio = emdCorrectness / manhattanCorrectness
+    # collect the results of every combination into the grids
+    resultsByGeometry = {(result["width"], result["height"]): result for result in results}
 
+    # since manhattan is consistent, keep the ratio instead
+    Z = [[resultsByGeometry[(width, height)]["ratio"] for height in Y] for width in X]
+    T = [[resultsByGeometry[(width, height)]["wall_time"] for height in Y] for width in X]
 
-            currZ.append(emdToManhattanRatio)
-            currT.append(end - start)
 
-        Z.append(currZ)
-        T.append(currT)
-
-
-    # make x and y appropriate 
+    # make x and y appropriate
     meshX, meshY = np.meshgrid(X, Y)
 
     # now that we have all the data, plot ratio of correctness
@@ -70,7 +61,7 @@ def main():
     ax.set_xlabel('width')
     ax.set_ylabel('height')
     plt.show()
-                
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import hashlib
+import os
+from functools import partial
+
+import numpy as np
+
+# magic numbers of the idx files we handle
+LABELS_MAGIC = 2049
+IMAGES_MAGIC = 2051
+# reduce.py writes its latent vectors with this one
+REDUCED_MAGIC = 69
+
+
+def readHeader(filename, dimensions):
+    with open(filename, mode='rb') as bytestream:
+        header = bytestream.read(4 * (dimensions + 1))
+
+    if len(header) != 4 * (dimensions + 1):
+        raise ValueError(filename + ": file too short for an idx header")
+
+    # magic number followed by the size of every dimension, all big endian
+    return [int.from_bytes(header[index:index + 4], byteorder='big') for index in range(0, len(header), 4)]
+
+
+def checkSize(filename, offset, count):
+    if os.path.getsize(filename) < offset + count:
+        raise ValueError(filename + ": header promises " + str(count) + " bytes of data but the file is shorter")
+
+
+def openImages(filename):
+    magic, numOfImages, numOfRows, numOfColumns = readHeader(filename, 3)
+
+    if magic not in (IMAGES_MAGIC, REDUCED_MAGIC):
+        raise ValueError(filename + ": bad magic number " + str(magic) + " for an image file")
+
+    checkSize(filename, 16, numOfImages * numOfRows * numOfColumns)
+
+    # map the pixels without reading them, nothing is loaded until it is accessed
+    if numOfImages == 0:
+        return np.zeros((0, numOfRows, numOfColumns), dtype=np.uint8)
+    return np.memmap(filename, dtype=np.uint8, mode='r', offset=16, shape=(numOfImages, numOfRows, numOfColumns))
+
+
+def readImages(filename, start=0, stop=None, dtype=np.float32):
+    # only the requested images are read and converted
+    return np.asarray(openImages(filename)[start:stop], dtype=dtype)
+
+
+def readLabels(filename):
+    magic, numOfLabels = readHeader(filename, 1)
+
+    if magic != LABELS_MAGIC:
+        raise ValueError(filename + ": bad magic number " + str(magic) + " for a label file")
+
+    checkSize(filename, 8, numOfLabels)
+
+    with open(filename, mode='rb') as bytestream:
+        bytestream.seek(8)
+        # convert data from bytes to numpy array
+        return np.frombuffer(bytestream.read(numOfLabels), dtype=np.uint8).astype(np.int64)
+
+
+def fileHash(filename):
+    digest = hashlib.sha256()
+
+    # hash in big chunks so that we never hold the whole dataset in memory
+    with open(filename, mode='rb') as bytestream:
+        for chunk in iter(partial(bytestream.read, 1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class ImageWriter:
+    def __init__(self, filename, numOfRows, numOfColumns, magic=IMAGES_MAGIC):
+        self.numOfRows = numOfRows
+        self.numOfColumns = numOfColumns
+        self.numOfImages = 0
+
+        # the number of images is patched in on close, so images can be appended in batches
+        self.binaryFile = open(filename, mode='wb')
+        self.binaryFile.write(np.array([magic, 0, numOfRows, numOfColumns], dtype='>u4').tobytes())
+
+    def append(self, images):
+        images = np.asarray(images)
+
+        if images.size and (images.min() < 0 or images.max() > 255):
+            raise ValueError("pixel values must fit in a byte")
+
+        images = np.ascontiguousarray(images, dtype=np.uint8).reshape(-1, self.numOfRows * self.numOfColumns)
+
+        # the whole batch goes out in a single write
+        self.binaryFile.write(images.data)
+        self.numOfImages += len(images)
+
+    def close(self):
+        if self.binaryFile.closed:
+            return
+
+        self.binaryFile.seek(4)
+        self.binaryFile.write(self.numOfImages.to_bytes(4, byteorder='big'))
+        self.binaryFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def writeImages(filename, images, magic=IMAGES_MAGIC):
+    images = np.asarray(images)
+
+    with ImageWriter(filename, images.shape[1], int(np.prod(images.shape[2:])), magic) as writer:
+        writer.append(images)
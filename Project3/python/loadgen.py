@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from idx import openImages
+
+
+async def connect(args):
+    if args.socket is not None:
+        return await asyncio.open_unix_connection(path=args.socket)
+    return await asyncio.open_connection(host="127.0.0.1", port=int(args.port))
+
+
+async def request(reader, writer, message):
+    writer.write((json.dumps(message) + "\n").encode())
+    await writer.drain()
+
+    return json.loads(await reader.readline())
+
+
+async def client(args, queryImages, requestIds, latencies, errors):
+    reader, writer = await connect(args)
+
+    # every client sends its requests one after the other, concurrency comes from the number of clients
+    for requestId in requestIds:
+        message = {"id": requestId, "op": args.op, "image": queryImages[requestId % len(queryImages)].tolist()}
+        if args.op == "knn":
+            message.update(metric=args.metric, k=int(args.k))
+
+        started = time.perf_counter()
+        response = await request(reader, writer, message)
+        latencies.append(time.perf_counter() - started)
+
+        if "error" in response:
+            errors.append(response["error"])
+
+    writer.close()
+    await writer.wait_closed()
+
+
+async def run(args):
+    queryImages = openImages(args.q)
+    queryImages = queryImages.reshape(len(queryImages), -1)
+
+    requests = int(args.n)
+    clients = int(args.clients)
+
+    latencies = []
+    errors = []
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(args, queryImages, range(clientIndex, requests, clients), latencies, errors) for clientIndex in range(clients)])
+    elapsed = time.perf_counter() - started
+
+    latencies = np.array(latencies)
+    print("requests: " + str(len(latencies)) + ", errors: " + str(len(errors)))
+    print("throughput: %.1f requests/s" % (len(latencies) / elapsed))
+    print("latency ms: mean %.2f, p50 %.2f, p90 %.2f, p99 %.2f, max %.2f" % tuple(1000 * value for value in
+          (latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99), latencies.max())))
+    if errors:
+        print("first error: " + errors[0])
+
+    # the server side view, batch sizes included
+    reader, writer = await connect(args)
+    print(json.dumps(await request(reader, writer, {"op": "stats"}), indent=2))
+    writer.close()
+    await writer.wait_closed()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-q')
+    parser.add_argument('-socket')
+    parser.add_argument('-port', default="5050")
+    parser.add_argument('-op', default="knn", choices=["knn", "encode", "cluster"])
+    parser.add_argument('-metric', default="manhattan", choices=["manhattan", "emd", "ann"])
+    parser.add_argument('-k', default="10")
+    parser.add_argument('-n', default="1000")
+    parser.add_argument('-clients', default="16")
+    args = parser.parse_args(argv)
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,19 @@
-import sys
+import os
 import argparse
 import math
+import shutil
+import tempfile
 
 import numpy as np
-import keras
-
-from tensorflow.keras.layers import Dropout,Conv2D,MaxPooling2D,UpSampling2D,Input,Reshape,Dense,Flatten,Conv2DTranspose
-from keras.layers.normalization import BatchNormalization
-from keras.models import Model,Sequential,load_model
-from keras.optimizers import RMSprop
-
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import normalize
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, classification_report, confusion_matrix
-
-import pandas as pd
-
-def readImages(filename):
-    with open(filename, mode='rb') as bytestream:
-        # throw away magic number
-        bytestream.read(4)
-        # read the number of images from the metadata
-        numOfImages = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of rows from the metadata
-        numOfRows = int.from_bytes(bytestream.read(4), byteorder='big')
-        # read the number of columns from the metadata
-        numOfColumns = int.from_bytes(bytestream.read(4), byteorder='big')
-
-        # read actual image data
-        buf = bytestream.read(numOfRows * numOfColumns * numOfImages)
-        # convert data from bytes to numpy array
-        data = np.frombuffer(buf, dtype=np.uint8).astype(np.float32)
-        # reshape so we can access the data of an image
-        data = data.reshape(numOfImages, numOfRows, numOfColumns)
-
-        return data, numOfImages
-
-def writeImages(filename, normal_predictions, numOfImages, numOfRows, numOfColumns):
-    with open(filename, mode='wb') as binary_file:
-        # write magic number
-        binary_file.write((69).to_bytes(4, byteorder='big'))
-        # write number of images
-        binary_file.write((numOfImages).to_bytes(4, byteorder='big'))
-        # write number of rows
-        binary_file.write((numOfRows).to_bytes(4, byteorder='big'))
-        # write number of columns
-        binary_file.write((numOfColumns).to_bytes(4, byteorder='big'))
-
-        # write pixels
-        for image in normal_predictions:
-            for pixel in image:
-                binary_file.write((int(pixel)).to_bytes(1, byteorder='big')) 
-
-
-def buildCompleteModel():
-
-    savedModelPath = "../models/autoencoder.h5"
+
+from idx import openImages, fileHash, ImageWriter, REDUCED_MAGIC
+
+def buildCompleteModel(savedModelPath="../models/autoencoder.h5"):
+    # keras is imported here, so that importing this module stays cheap
+    from keras.models import Sequential, load_model
 
     # we need to load the saved model and add the encoder layers to a new model
-    savedModel = load_model(savedModelPath)
+    savedModel = load_model(savedModelPath, compile=False)
 
     # create a new model and insert the layers
     fullModel = Sequential()
@@ -68,18 +23,84 @@ def buildCompleteModel():
 
     for layerNumber in range(numberOfEncoderLayers):
         fullModel.add(savedModel.layers[layerNumber])
-    
-    fullModel.compile(loss=keras.losses.categorical_crossentropy, optimizer=keras.optimizers.Adam(),metrics=['accuracy'])
 
+    # the encoder is only used for inference, so it is never compiled
     return fullModel
 
-def main():
+def exportEncoder(savedModelPath, encoderPath):
+    encoder = buildCompleteModel(savedModelPath)
+
+    # save next to the final location and swap it in, so a half written export is never loaded
+    temporaryPath = encoderPath + "." + str(os.getpid()) + ".tmp"
+    encoder.save(temporaryPath, include_optimizer=False)
+
+    # remember which autoencoder the export was made from
+    with open(os.path.join(temporaryPath, "source.sha256"), mode='w') as sourceFile:
+        sourceFile.write(fileHash(savedModelPath))
+
+    if os.path.exists(encoderPath):
+        shutil.rmtree(encoderPath)
+    os.replace(temporaryPath, encoderPath)
+
+    return encoder
+
+def loadEncoder(savedModelPath, encoderPath):
+    sourceHashPath = os.path.join(encoderPath, "source.sha256")
+
+    # reuse the exported encoder as long as the autoencoder it came from did not change
+    if os.path.exists(sourceHashPath):
+        with open(sourceHashPath) as sourceFile:
+            if sourceFile.read() == fileHash(savedModelPath):
+                from keras.models import load_model
+                return load_model(encoderPath, compile=False)
+
+    return exportEncoder(savedModelPath, encoderPath)
+
+def encodeImages(model, imagesFilePath, latentFilePath, batchSize):
+    images = openImages(imagesFilePath)
+    numOfImages, numOfRows, numOfColumns = images.shape
+
+    # inputs are scaled by the largest pixel of their file, found without loading it
+    maxPixel = float(images.max())
+
+    latents = None
+
+    for start in range(0, numOfImages, batchSize):
+        # only one batch is ever converted to float32, and it is normalized in place
+        batch = np.asarray(images[start:start + batchSize], dtype=np.float32)
+        batch /= maxPixel
+
+        predictions = model.predict_on_batch(batch.reshape(-1, numOfRows, numOfColumns, 1))
+
+        # latent vectors are spilled to disk until we know how to scale them
+        if latents is None:
+            latents = np.lib.format.open_memmap(latentFilePath, mode='w+', dtype=np.float32, shape=(numOfImages, predictions.shape[1]))
+        latents[start:start + len(batch)] = predictions
+
+    return latents
+
+def writeLatents(filename, latents, scale, batchSize):
+    with ImageWriter(filename, 1, latents.shape[1], REDUCED_MAGIC) as writer:
+        for start in range(0, len(latents), batchSize):
+            # normalize predictions to bytes
+            writer.append((latents[start:start + batchSize] / scale * 255).astype(int))
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d')
     parser.add_argument('-q')
     parser.add_argument('-od')
     parser.add_argument('-oq')
-    args = parser.parse_args()
+    parser.add_argument('-batch', default="1024")
+    parser.add_argument('-model', default="../models/autoencoder.h5")
+    parser.add_argument('-encoder', default="../models/encoder")
+    parser.add_argument('-export', action='store_true')
+    args = parser.parse_args(argv)
+
+    # only export the encoder of the autoencoder and exit
+    if args.export:
+        exportEncoder(args.model, args.encoder)
+        return
 
     datasetFilePath = args.d
     querysetFilePath = args.q
@@ -87,27 +108,23 @@ def main():
     outDatasetFilePath = args.od
     outQuerysetFilePath = args.oq
 
-    # read the data into memory once
-    dataset, dNumOfImages = readImages(datasetFilePath)
-    dataset = dataset.reshape(-1, 28,28, 1)
-    dataset = dataset / np.max(dataset)
+    batchSize = int(args.batch)
+
+    model = loadEncoder(args.model, args.encoder)
 
-    queryset, qNumOfImages = readImages(querysetFilePath)
-    queryset = queryset.reshape(-1, 28,28, 1)
-    queryset = queryset / np.max(queryset)
+    with tempfile.TemporaryDirectory() as temporaryDirectory:
+        # encode both sets batch by batch
+        datasetLatents = encodeImages(model, datasetFilePath, os.path.join(temporaryDirectory, "dataset.npy"), batchSize)
+        querysetLatents = encodeImages(model, querysetFilePath, os.path.join(temporaryDirectory, "queryset.npy"), batchSize)
 
-    # compute predictions
-    model = buildCompleteModel()
-    predictions = model.predict(dataset)
+        # both sets share one scale so that their latent vectors stay comparable
+        scale = max(float(datasetLatents.max()), float(querysetLatents.max()))
 
-    # normalize predictions
-    predictions = predictions / np.max(predictions)
-    predictions = predictions * 255
-    predictions = predictions.astype(int)
+        # write new data
+        writeLatents(outDatasetFilePath, datasetLatents, scale, batchSize)
+        writeLatents(outQuerysetFilePath, querysetLatents, scale, batchSize)
 
-    # write new data
-    writeImages(outDatasetFilePath, predictions, dNumOfImages, 1, len(predictions[0]))
-    writeImages(outQuerysetFilePath, predictions, qNumOfImages, 1, len(predictions[0]))
+        del datasetLatents, querysetLatents
 
 
 
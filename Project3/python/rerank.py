@@ -0,0 +1,188 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from idx import openImages, readLabels
+from emd import computeSignatures, loadSignatures, manhattanNearestNeighbors, prunedNearestNeighbors, totalCorrectness
+
+
+def encodeLatents(inputFilePath, queryFilePath, savedModelPath, encoderPath, batchSize):
+    # keras is only needed when the latent vectors are not given as reduce.py files
+    from reduce import loadEncoder, encodeImages
+
+    model = loadEncoder(savedModelPath, encoderPath)
+
+    with tempfile.TemporaryDirectory() as temporaryDirectory:
+        inputLatents = encodeImages(model, inputFilePath, os.path.join(temporaryDirectory, "input.npy"), batchSize)
+        queryLatents = encodeImages(model, queryFilePath, os.path.join(temporaryDirectory, "query.npy"), batchSize)
+
+        # scale both sets to bytes with a shared maximum, exactly as reduce.py writes them
+        scale = max(float(inputLatents.max()), float(queryLatents.max()))
+        inputLatents = (inputLatents / scale * 255).astype(np.uint8)
+        queryLatents = (queryLatents / scale * 255).astype(np.uint8)
+
+    return inputLatents, queryLatents
+
+
+def latentCandidates(queryLatents, inputLatents, M, memoryBudget=256 << 20):
+    # latent vectors are bytes too, so the blocked manhattan search works on them unchanged
+    return manhattanNearestNeighbors(queryLatents, inputLatents, M, memoryBudget)
+
+
+def rerankManhattan(queryImage, inputImages, candidates, k):
+    distances = np.abs(np.asarray(inputImages[candidates], dtype=np.int16) - np.asarray(queryImage, dtype=np.int16)).sum(axis=1, dtype=np.int64)
+
+    # ties go to the lower id, as in kNearestNeighbors
+    return candidates[np.lexsort((candidates, distances))[:k]]
+
+
+def rerankEmd(querySignature, inputSignatures, candidates, k, width, height, solver):
+    # candidates come sorted by latent distance, the pruned search wants them by id
+    candidates = np.sort(candidates)
+    neighbors, solves = prunedNearestNeighbors(querySignature, inputSignatures[candidates], k, width, height, solver)
+
+    return [int(candidates[neighbor]) for neighbor in neighbors], solves
+
+
+def twoStageSearch(queryImages, queryLatents, querySignatures, inputImages, inputLatents, inputSignatures, settings):
+    k = settings["k"]
+
+    latentStart = time.perf_counter()
+    candidates = latentCandidates(queryLatents, inputLatents, settings["M"], settings["memoryBudget"])
+    latentTime = time.perf_counter() - latentStart
+
+    # only the M candidates of every query are compared in the original space
+    rerankStart = time.perf_counter()
+    neighbors = []
+    solves = []
+    for queryIndex in range(len(queryImages)):
+        if settings["metric"] == "emd":
+            queryNeighbors, querySolves = rerankEmd(querySignatures[queryIndex], inputSignatures, candidates[queryIndex], k, settings["width"], settings["height"], settings["solver"])
+        else:
+            queryNeighbors, querySolves = rerankManhattan(queryImages[queryIndex], inputImages, candidates[queryIndex], k), 0
+        neighbors.append(queryNeighbors)
+        solves.append(querySolves)
+    rerankTime = time.perf_counter() - rerankStart
+
+    return neighbors, solves, latentTime, rerankTime
+
+
+def exhaustiveSearch(queryImages, querySignatures, inputImages, inputSignatures, settings):
+    k = settings["k"]
+
+    if settings["metric"] == "manhattan":
+        return list(manhattanNearestNeighbors(queryImages, inputImages, k, settings["memoryBudget"])), [0] * len(queryImages)
+
+    # the lower bounds only skip solves that cannot change the result, so this is exact
+    neighbors = []
+    solves = []
+    for querySignature in querySignatures:
+        queryNeighbors, querySolves = prunedNearestNeighbors(querySignature, inputSignatures, k, settings["width"], settings["height"], settings["solver"])
+        neighbors.append(queryNeighbors)
+        solves.append(querySolves)
+
+    return neighbors, solves
+
+
+def recall(neighbors, exactNeighbors, k):
+    return sum(len(set(approximate) & set(exact)) / k for (approximate, exact) in zip(neighbors, exactNeighbors)) / len(exactNeighbors)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d')
+    parser.add_argument('-q')
+    parser.add_argument('-dr')
+    parser.add_argument('-qr')
+    parser.add_argument('-l1')
+    parser.add_argument('-l2')
+    parser.add_argument('-o')
+    parser.add_argument('-metric', default="manhattan", choices=["manhattan", "emd"])
+    parser.add_argument('-M', default="100")
+    parser.add_argument('-k', default="10")
+    parser.add_argument('-exact')
+    parser.add_argument('-width', default="7")
+    parser.add_argument('-height', default="7")
+    parser.add_argument('-solver', default="transport", choices=["transport", "linprog", "grid"])
+    parser.add_argument('-store')
+    parser.add_argument('-memory', default="256")
+    parser.add_argument('-model', default="../models/autoencoder.h5")
+    parser.add_argument('-encoder', default="../models/encoder")
+    parser.add_argument('-batch', default="1024")
+    args = parser.parse_args(argv)
+
+    if (args.dr is None) != (args.qr is None):
+        parser.error("-dr and -qr must be given together, latent vectors of both sets need the same scale")
+
+    settings = {"metric": args.metric, "M": int(args.M), "k": int(args.k), "width": int(args.width), "height": int(args.height),
+                "solver": args.solver, "memoryBudget": int(args.memory) << 20}
+
+    # map images, one flat row of bytes per image
+    inputImages = openImages(args.d)
+    inputImages = inputImages.reshape(len(inputImages), -1)
+    queryImages = openImages(args.q)
+    queryImages = queryImages.reshape(len(queryImages), -1)
+
+    # latent vectors either come from reduce.py or are encoded here with the cached encoder
+    encodingStart = time.perf_counter()
+    if args.dr is not None:
+        inputLatents = openImages(args.dr)
+        inputLatents = inputLatents.reshape(len(inputLatents), -1)
+        queryLatents = openImages(args.qr)
+        queryLatents = queryLatents.reshape(len(queryLatents), -1)
+    else:
+        inputLatents, queryLatents = encodeLatents(args.d, args.q, args.model, args.encoder, int(args.batch))
+    encodingTime = time.perf_counter() - encodingStart
+
+    if len(inputLatents) != len(inputImages) or len(queryLatents) != len(queryImages):
+        raise ValueError("latent vectors and images do not have the same number of entries")
+
+    inputSignatures = None
+    querySignatures = None
+    if settings["metric"] == "emd":
+        if args.store is not None:
+            inputSignatures = loadSignatures(args.store, args.d, settings["width"], settings["height"])
+        else:
+            inputSignatures = computeSignatures(inputImages, settings["width"], settings["height"])
+        querySignatures = computeSignatures(queryImages, settings["width"], settings["height"])
+
+    neighbors, solves, latentTime, rerankTime = twoStageSearch(queryImages, queryLatents, querySignatures, inputImages, inputLatents, inputSignatures, settings)
+
+    # exhaustive search of the first queries only, it is the expensive part
+    exactQueries = int(args.exact) if args.exact is not None else len(queryImages)
+    exactStart = time.perf_counter()
+    exactNeighbors, exactSolves = exhaustiveSearch(queryImages[:exactQueries], None if querySignatures is None else querySignatures[:exactQueries],
+                                                   inputImages, inputSignatures, settings)
+    exactTime = time.perf_counter() - exactStart
+
+    # compare times per query, the exhaustive search may have seen fewer of them
+    twoStageTime = (latentTime + rerankTime) / len(queryImages)
+    exhaustiveTime = exactTime / max(1, exactQueries)
+
+    outputFile = open(args.o, 'w')
+    outputFile.write("Recall@" + str(settings["k"]) + " Two-Stage: " + str(recall(neighbors, exactNeighbors, settings["k"])) + "\n")
+    outputFile.write("Candidates Per Query: " + str(min(settings["M"], len(inputImages))) + "\n")
+    if settings["metric"] == "emd":
+        outputFile.write("Average EMD Solves Two-Stage: " + str(sum(solves) / len(solves)) + "\n")
+        outputFile.write("Average EMD Solves Exhaustive: " + str(sum(exactSolves) / max(1, len(exactSolves))) + "\n")
+
+    if args.l1 is not None and args.l2 is not None:
+        inputLabels = readLabels(args.l1)
+        queryLabels = readLabels(args.l2)
+        outputFile.write("Average Correct Search Results Two-Stage: " + str(totalCorrectness(neighbors, queryLabels, inputLabels, settings["k"])) + "\n")
+        outputFile.write("Average Correct Search Results Exhaustive: " + str(totalCorrectness(exactNeighbors, queryLabels, inputLabels, settings["k"])) + "\n")
+
+    outputFile.write("tEncoding: " + str(encodingTime) + "\n")
+    outputFile.write("tLatent: " + str(latentTime) + "\n")
+    outputFile.write("tRerank: " + str(rerankTime) + "\n")
+    outputFile.write("tTwoStage Per Query: " + str(twoStageTime) + "\n")
+    outputFile.write("tExhaustive Per Query: " + str(exhaustiveTime) + "\n")
+    outputFile.write("Speedup: " + str(exhaustiveTime / twoStageTime if twoStageTime else float('inf')) + "\n")
+    outputFile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from idx import openImages, readLabels
+from emd import computeSignatures, loadSignatures, manhattanNearestNeighbors, prunedNearestNeighbors
+
+# latencies of the last requests kept for the percentiles of every operation
+LATENCY_WINDOW = 10000
+
+# datasets, signatures, models and indexes, loaded once by loadState
+serverState = {}
+
+
+class Counters:
+    def __init__(self):
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def snapshot(self, uptime):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+
+        return {"requests": self.requests,
+                "batches": self.batches,
+                "errors": self.errors,
+                "meanBatchSize": self.requests / self.batches if self.batches else 0.0,
+                "throughput": self.requests / uptime if uptime else 0.0,
+                "latency": {"mean": float(latencies.mean()),
+                            "p50": float(np.percentile(latencies, 50)),
+                            "p90": float(np.percentile(latencies, 90)),
+                            "p99": float(np.percentile(latencies, 99)),
+                            "max": float(latencies.max())}}
+
+
+class MicroBatcher:
+    def __init__(self, function, maxBatch, maxDelay, executor):
+        self.function = function
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.executor = executor
+        self.queue = asyncio.Queue()
+        self.counters = Counters()
+
+    async def submit(self, payload):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((payload, future, time.perf_counter()))
+
+        return await future
+
+    def drain(self, items):
+        while len(items) < self.maxBatch and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            items = [await self.queue.get()]
+
+            # give concurrent requests a moment to join the batch, unless it is already full
+            self.drain(items)
+            if len(items) < self.maxBatch and self.maxDelay > 0:
+                await asyncio.sleep(self.maxDelay)
+                self.drain(items)
+
+            # the batch runs outside the event loop, so connections keep being served meanwhile
+            try:
+                results = await loop.run_in_executor(self.executor, self.function, [payload for (payload, _, _) in items])
+            except Exception as error:
+                self.counters.errors += len(items)
+                for (_, future, _) in items:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            finished = time.perf_counter()
+            for (_, future, started), result in zip(items, results):
+                self.counters.latencies.append(finished - started)
+                if not future.done():
+                    future.set_result(result)
+
+            self.counters.requests += len(items)
+            self.counters.batches += 1
+
+
+def loadState(args):
+    # map images, one flat row of bytes per image, and keep them in memory
+    inputImages = openImages(args.d)
+    serverState["imageShape"] = inputImages.shape[1:]
+    serverState["inputImages"] = np.array(inputImages.reshape(len(inputImages), -1))
+    serverState["maxPixel"] = float(serverState["inputImages"].max())
+    serverState["inputLabels"] = readLabels(args.l) if args.l is not None else None
+    serverState["settings"] = {"width": int(args.width), "height": int(args.height), "solver": args.solver, "memoryBudget": int(args.memory) << 20}
+
+    width = serverState["settings"]["width"]
+    height = serverState["settings"]["height"]
+    if args.store is not None:
+        serverState["inputSignatures"] = loadSignatures(args.store, args.d, width, height)
+    else:
+        serverState["inputSignatures"] = computeSignatures(serverState["inputImages"], width, height)
+
+    if args.ann is not None:
+        from ann import readConfig, CONFIG_DEFAULTS, LSH, HyperCube
+
+        config = readConfig(args.c) if args.c is not None else dict(CONFIG_DEFAULTS)
+        if args.ann == "LSH":
+            serverState["index"] = LSH(serverState["inputImages"], config["number_of_vector_hash_tables"], config["number_of_vector_hash_functions"])
+        else:
+            serverState["index"] = HyperCube(serverState["inputImages"], config["number_of_hypercube_dimensions"], config["max_number_M_hypercube"], config["number_of_probes"])
+
+    # keras is only imported when a model is actually served
+    if args.encoder is not None:
+        from reduce import loadEncoder
+        serverState["encoder"] = loadEncoder(args.model, args.encoder)
+
+    if args.classifier is not None:
+        from keras.models import load_model
+        serverState["classifier"] = load_model(args.classifier, compile=False)
+
+
+def neighborResults(neighbors, requestedKs):
+    labels = serverState["inputLabels"]
+
+    results = []
+    for queryNeighbors, k in zip(neighbors, requestedKs):
+        queryNeighbors = [int(neighbor) for neighbor in queryNeighbors[:k]]
+        result = {"neighbors": queryNeighbors}
+        if labels is not None:
+            result["labels"] = [int(labels[neighbor]) for neighbor in queryNeighbors]
+        results.append(result)
+
+    return results
+
+
+def manhattanBatch(payloads):
+    images = np.stack([image for (image, _) in payloads])
+    requestedKs = [k for (_, k) in payloads]
+
+    # one blocked search for the whole batch, every request takes the prefix it asked for
+    neighbors = manhattanNearestNeighbors(images, serverState["inputImages"], max(requestedKs), serverState["settings"]["memoryBudget"])
+
+    return neighborResults(neighbors, requestedKs)
+
+
+def emdBatch(payloads):
+    settings = serverState["settings"]
+    signatures = computeSignatures(np.stack([image for (image, _) in payloads]), settings["width"], settings["height"])
+
+    neighbors = [prunedNearestNeighbors(signature, serverState["inputSignatures"], k, settings["width"], settings["height"], settings["solver"])[0]
+                 for signature, (_, k) in zip(signatures, payloads)]
+
+    return neighborResults(neighbors, [k for (_, k) in payloads])
+
+
+def annBatch(payloads):
+    requestedKs = [k for (_, k) in payloads]
+    results = serverState["index"].kNearestNeighbors(np.stack([image for (image, _) in payloads]), max(requestedKs))
+
+    return neighborResults([neighbors for (neighbors, _) in results], requestedKs)
+
+
+def modelInputs(payloads):
+    # scaled by the largest pixel of the served dataset, as the files are in reduce.py and clusterify.py
+    images = np.stack(payloads).astype(np.float32) / serverState["maxPixel"]
+
+    return images.reshape((-1,) + tuple(serverState["imageShape"]) + (1,))
+
+
+def encodeBatch(payloads):
+    latents = serverState["encoder"].predict_on_batch(modelInputs(payloads))
+
+    return [{"latent": [float(value) for value in latent]} for latent in np.asarray(latents)]
+
+
+def clusterBatch(payloads):
+    predictions = serverState["classifier"].predict_on_batch(modelInputs(payloads))
+
+    return [{"cluster": int(cluster)} for cluster in np.argmax(np.asarray(predictions), axis=1)]
+
+
+def parseImage(message):
+    image = np.asarray(message.get("image"), dtype=np.int64).ravel()
+
+    if image.size != serverState["inputImages"].shape[1]:
+        raise ValueError("image must have " + str(serverState["inputImages"].shape[1]) + " pixels")
+    if image.min() < 0 or image.max() > 255:
+        raise ValueError("pixel values must fit in a byte")
+
+    return image.astype(np.uint8)
+
+
+async def answer(message, batchers, startTime):
+    operation = message.get("op")
+
+    if operation == "stats":
+        uptime = time.perf_counter() - startTime
+        return {"uptime": uptime, "operations": {name: batcher.counters.snapshot(uptime) for name, batcher in batchers.items()}}
+
+    if operation == "knn":
+        metric = message.get("metric", "manhattan")
+        if metric not in batchers:
+            raise ValueError("metric " + str(metric) + " is not served")
+        k = int(message.get("k", 10))
+        if k < 1:
+            raise ValueError("k must be positive")
+
+        return await batchers[metric].submit((parseImage(message), k))
+
+    if operation in ("encode", "cluster"):
+        if operation not in batchers:
+            raise ValueError(operation + " is not served, the server was started without its model")
+
+        return await batchers[operation].submit(parseImage(message))
+
+    raise ValueError("unknown operation " + str(operation))
+
+
+async def respond(line, writer, batchers, startTime):
+    message = {}
+    try:
+        message = json.loads(line)
+        if not isinstance(message, dict):
+            raise ValueError("a request must be a json object")
+        response = await answer(message, batchers, startTime)
+    except Exception as error:
+        response = {"error": str(error)}
+
+    # responses may come back out of order, the id of the request tells them apart
+    if isinstance(message, dict) and "id" in message:
+        response["id"] = message["id"]
+    writer.write((json.dumps(response) + "\n").encode())
+
+
+async def handleConnection(reader, writer, batchers, startTime):
+    # one json request per line, every request is answered on its own so a connection can pipeline
+    tasks = set()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.create_task(respond(line, writer, batchers, startTime))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    executor = ThreadPoolExecutor(int(args.threads))
+    maxBatch = int(args.batch)
+    maxDelay = float(args.delay) / 1000
+
+    functions = {"manhattan": manhattanBatch, "emd": emdBatch}
+    if "index" in serverState:
+        functions["ann"] = annBatch
+    if "encoder" in serverState:
+        functions["encode"] = encodeBatch
+    if "classifier" in serverState:
+        functions["cluster"] = clusterBatch
+
+    batchers = {name: MicroBatcher(function, maxBatch, maxDelay, executor) for name, function in functions.items()}
+    for batcher in batchers.values():
+        asyncio.create_task(batcher.run())
+
+    startTime = time.perf_counter()
+
+    def connected(reader, writer):
+        return handleConnection(reader, writer, batchers, startTime)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = await asyncio.start_unix_server(connected, path=args.socket)
+    else:
+        server = await asyncio.start_server(connected, host="127.0.0.1", port=int(args.port))
+
+    print("serving " + ", ".join(batchers) + " on " + (args.socket if args.socket is not None else "127.0.0.1:" + args.port), flush=True)
+
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d')
+    parser.add_argument('-l')
+    parser.add_argument('-socket')
+    parser.add_argument('-port', default="5050")
+    parser.add_argument('-width', default="7")
+    parser.add_argument('-height', default="7")
+    parser.add_argument('-solver', default="transport", choices=["transport", "linprog", "grid"])
+    parser.add_argument('-store')
+    parser.add_argument('-memory', default="256")
+    parser.add_argument('-ann', choices=["LSH", "Hypercube"])
+    parser.add_argument('-c')
+    parser.add_argument('-model', default="../models/autoencoder.h5")
+    parser.add_argument('-encoder')
+    parser.add_argument('-classifier')
+    parser.add_argument('-batch', default="64")
+    parser.add_argument('-delay', default="2")
+    parser.add_argument('-threads', default="1")
+    args = parser.parse_args(argv)
+
+    loadState(args)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
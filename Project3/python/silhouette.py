@@ -0,0 +1,246 @@
+import argparse
+import math
+from multiprocessing import Pool
+from statistics import NormalDist
+
+import numpy as np
+
+from idx import openImages
+
+# images and cluster membership of a worker process, set once by openClustering
+silhouetteState = {}
+
+
+def readClusters(filename, numOfImages):
+    clusters = []
+
+    # same parsing as readClustersFromFile: ids follow the first comma, up to the closing brace
+    with open(filename) as clusterFile:
+        for line in clusterFile:
+            line = line.rstrip("\r\n")
+            if line == "":
+                break
+
+            ids = line.split(",", 1)[1].split("}", 1)[0].replace(",", " ").split() if "," in line else []
+            cluster = np.unique(np.array([int(imageId) for imageId in ids], dtype=np.int64))
+
+            if len(cluster) and cluster[-1] >= numOfImages:
+                raise ValueError(filename + ": image " + str(cluster[-1]) + " does not exist, there are " + str(numOfImages) + " images")
+            clusters.append(cluster)
+
+    return clusters
+
+
+def clusterLabels(clusters, numOfImages):
+    # images of no cluster keep -1, they count for the objective function only
+    labels = np.full(numOfImages, -1, dtype=np.int64)
+
+    for clusterIndex, cluster in enumerate(clusters):
+        if (labels[cluster] != -1).any():
+            raise ValueError("an image belongs to more than one cluster")
+        labels[cluster] = clusterIndex
+
+    return labels
+
+
+def centroidize(images, clusters):
+    # every pixel of a centroid is the median of that pixel over the cluster, the upper one for even sizes
+    centroids = np.zeros((len(clusters), images.shape[1]), dtype=np.uint8)
+
+    for clusterIndex, cluster in enumerate(clusters):
+        if len(cluster):
+            pixels = np.asarray(images[cluster])
+            centroids[clusterIndex] = np.partition(pixels, len(cluster) // 2, axis=0)[len(cluster) // 2]
+
+    return centroids
+
+
+def manhattanBlock(rowImages, columnImages):
+    return np.abs(np.asarray(rowImages, dtype=np.int16)[:, None, :] - np.asarray(columnImages, dtype=np.int16)[None, :, :]).sum(axis=2, dtype=np.int64)
+
+
+def blockSizes(pixels, memoryBudget):
+    rowBlockSize = 32
+    columnBlockSize = max(1, memoryBudget // (rowBlockSize * pixels * np.dtype(np.int16).itemsize))
+
+    return rowBlockSize, columnBlockSize
+
+
+def centroidDistances(images, centroids, memoryBudget=256 << 20):
+    # distance of every image to every centroid, k is small so this is n x k
+    rowBlockSize, _ = blockSizes(images.shape[1] * len(centroids), memoryBudget)
+    distances = np.empty((len(images), len(centroids)), dtype=np.int64)
+
+    for start in range(0, len(images), rowBlockSize):
+        distances[start:start + rowBlockSize] = manhattanBlock(images[start:start + rowBlockSize], centroids)
+
+    return distances
+
+
+def objectiveFunction(centroidDistances):
+    # sum of the squared distance of every image to its closest centroid, kept exact in python ints
+    return int(sum(int(distance) ** 2 for distance in centroidDistances.min(axis=1)))
+
+
+def nextBestClusters(centroidDistances, labels):
+    # the closest centroid other than the own one, lower index on ties, as getNextBestCluster
+    distances = centroidDistances.astype(np.float64)
+    clustered = labels >= 0
+    distances[np.flatnonzero(clustered), labels[clustered]] = np.inf
+
+    return np.argmin(distances, axis=1)
+
+
+def openClustering(imagesPath, labels, clusterCount, memoryBudget):
+    images = openImages(imagesPath)
+
+    silhouetteState["images"] = images.reshape(len(images), -1)
+    silhouetteState["labels"] = labels
+    silhouetteState["clusterCount"] = clusterCount
+    silhouetteState["memoryBudget"] = memoryBudget
+
+
+def clusterDistanceSums(rowIds):
+    images = silhouetteState["images"]
+    labels = silhouetteState["labels"]
+    clusterCount = silhouetteState["clusterCount"]
+    rowBlockSize, columnBlockSize = blockSizes(images.shape[1], silhouetteState["memoryBudget"])
+
+    # sum of the distances of every row image to the images of each cluster, only one block
+    # of distances exists at a time, the sums are integers far below 2^53 so float64 is exact
+    sums = np.zeros((len(rowIds), clusterCount))
+
+    for rowStart in range(0, len(rowIds), rowBlockSize):
+        rowImages = images[rowIds[rowStart:rowStart + rowBlockSize]]
+
+        for columnStart in range(0, len(images), columnBlockSize):
+            columnLabels = labels[columnStart:columnStart + columnBlockSize]
+            membership = np.zeros((len(columnLabels), clusterCount))
+            clustered = np.flatnonzero(columnLabels >= 0)
+            membership[clustered, columnLabels[clustered]] = 1
+
+            sums[rowStart:rowStart + len(rowImages)] += manhattanBlock(rowImages, images[columnStart:columnStart + columnBlockSize]) @ membership
+
+    return sums
+
+
+def imageSilhouettes(rowIds, sums, labels, nextBest, clusterSizes):
+    rows = np.arange(len(rowIds))
+    own = labels[rowIds]
+    other = nextBest[rowIds]
+
+    # a divides by the other members of the cluster, b by every member of the next best cluster
+    a = sums[rows, own] / np.maximum(clusterSizes[own] - 1, 1)
+    b = np.divide(sums[rows, other], clusterSizes[other], out=np.zeros(len(rowIds)), where=clusterSizes[other] > 0)
+
+    silhouettes = np.zeros(len(rowIds))
+    closer = a < b
+    silhouettes[closer] = 1.0 - a[closer] / b[closer]
+    farther = ~closer & (a > 0)
+    silhouettes[farther] = b[farther] / a[farther] - 1.0
+
+    return silhouettes
+
+
+def stratifiedSample(clusters, fraction, random):
+    # every cluster is sampled on its own, with at least two images so that its variance exists
+    return [np.sort(random.choice(cluster, min(len(cluster), max(2, math.ceil(fraction * len(cluster)))), replace=False)) if len(cluster) else cluster
+            for cluster in clusters]
+
+
+def evaluateClustering(imagesPath, clusters, labels, centroidDistances, rowClusters, workers=1, memoryBudget=256 << 20):
+    clusterCount = len(clusters)
+    clusterSizes = np.array([len(cluster) for cluster in clusters], dtype=np.int64)
+    nextBest = nextBestClusters(centroidDistances, labels)
+
+    rowIds = np.concatenate(rowClusters) if rowClusters else np.zeros(0, dtype=np.int64)
+    chunkSize = max(1, math.ceil(len(rowIds) / (workers * 4)))
+    chunks = [rowIds[start:start + chunkSize] for start in range(0, len(rowIds), chunkSize)]
+
+    # every process maps the images itself, rows are split in a few chunks per process
+    state = (imagesPath, labels, clusterCount, memoryBudget)
+    if workers > 1:
+        with Pool(workers, initializer=openClustering, initargs=state) as pool:
+            sums = pool.map(clusterDistanceSums, chunks)
+    else:
+        openClustering(*state)
+        sums = [clusterDistanceSums(chunk) for chunk in chunks]
+
+    silhouettes = imageSilhouettes(rowIds, np.concatenate(sums) if sums else np.zeros((0, clusterCount)), labels, nextBest, clusterSizes)
+
+    # back to one array of silhouettes per cluster
+    return np.split(silhouettes, np.cumsum([len(rows) for rows in rowClusters])[:-1])
+
+
+def clusterEstimates(clusterSilhouettes, clusters, confidence):
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+
+    means = []
+    halfWidths = []
+    for silhouettes, cluster in zip(clusterSilhouettes, clusters):
+        if len(silhouettes) == 0:
+            means.append(0.0)
+            halfWidths.append(0.0)
+            continue
+
+        # standard error of a sample without replacement from a finite cluster
+        correction = 1.0 - len(silhouettes) / len(cluster)
+        variance = silhouettes.var(ddof=1) / len(silhouettes) * correction if len(silhouettes) > 1 else 0.0
+        means.append(float(silhouettes.mean()))
+        halfWidths.append(z * math.sqrt(variance))
+
+    # the total is the plain mean of the cluster silhouettes, as in calculateSilhouettes
+    means.append(sum(means) / len(clusters))
+    halfWidths.append(math.sqrt(sum(halfWidth ** 2 for halfWidth in halfWidths)) / len(clusters))
+
+    return means, halfWidths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d')
+    parser.add_argument('-c')
+    parser.add_argument('-o')
+    parser.add_argument('-workers', default="1")
+    parser.add_argument('-memory', default="256")
+    parser.add_argument('-sample')
+    parser.add_argument('-confidence', default="0.95")
+    parser.add_argument('-seed')
+    args = parser.parse_args(argv)
+
+    memoryBudget = int(args.memory) << 20
+    confidence = float(args.confidence)
+
+    images = openImages(args.d)
+    images = images.reshape(len(images), -1)
+
+    clusters = readClusters(args.c, len(images))
+    if not clusters:
+        raise ValueError(args.c + ": no clusters")
+    labels = clusterLabels(clusters, len(images))
+
+    centroids = centroidize(images, clusters)
+    distances = centroidDistances(images, centroids, memoryBudget)
+
+    # either every clustered image or a stratified sample of each cluster
+    if args.sample is not None:
+        random = np.random.RandomState(int(args.seed) if args.seed is not None else None)
+        rowClusters = stratifiedSample(clusters, float(args.sample), random)
+    else:
+        rowClusters = clusters
+
+    clusterSilhouettes = evaluateClustering(args.d, clusters, labels, distances, rowClusters, int(args.workers), memoryBudget)
+    means, halfWidths = clusterEstimates(clusterSilhouettes, clusters, confidence)
+
+    # same lines as the C++ cluster program, [s1, ..., sk, sTotal]
+    with open(args.o, mode='w') as outputFile:
+        outputFile.write("Silhouette: [" + ", ".join([str(mean) for mean in means]) + "]\n")
+        if args.sample is not None:
+            outputFile.write("Silhouette " + str(round(confidence * 100, 2)) + "% Confidence Intervals: [" +
+                             ", ".join(["(" + str(max(-1.0, mean - halfWidth)) + ", " + str(min(1.0, mean + halfWidth)) + ")" for mean, halfWidth in zip(means, halfWidths)]) + "]\n")
+            outputFile.write("Sampled Images: " + str(sum(len(rows) for rows in rowClusters)) + " of " + str(sum(len(cluster) for cluster in clusters)) + "\n")
+        outputFile.write("Value of Objective Function: " + str(objectiveFunction(distances)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
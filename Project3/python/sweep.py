@@ -0,0 +1,128 @@
+import argparse
+import csv
+from multiprocessing import Pool
+
+import emd
+from idx import openImages, readLabels
+from emd import Profiler, evaluate, loadSignatures
+
+# columns of the result table, one row per window geometry
+RESULT_FIELDS = ["width", "height", "emd_correct", "manhattan_correct", "emd_accuracy", "manhattan_accuracy",
+                 "ratio", "wall_time", "search_time", "solve_time", "solves"]
+
+# datasets and settings of a sweep process, opened once by openDatasets
+sweepState = {}
+
+
+def openDatasets(inputFilePath, queryFilePath, inputLabelsPath, queryLabelsPath, settings, storePath):
+    # images are memory mapped, so every process shares the same pages
+    inputImages = openImages(inputFilePath)
+    queryImages = openImages(queryFilePath)
+
+    sweepState["inputFilePath"] = inputFilePath
+    sweepState["inputImages"] = inputImages.reshape(len(inputImages), -1)
+    sweepState["queryImages"] = queryImages.reshape(len(queryImages), -1)
+    sweepState["inputLabels"] = readLabels(inputLabelsPath)
+    sweepState["queryLabels"] = readLabels(queryLabelsPath)
+    sweepState["settings"] = settings
+    sweepState["storePath"] = storePath
+
+
+def evaluateConfiguration(configuration):
+    width, height = configuration
+    settings = dict(sweepState["settings"], width=width, height=height)
+
+    inputSignatures = None
+    if sweepState["storePath"] is not None:
+        inputSignatures = loadSignatures(sweepState["storePath"], sweepState["inputFilePath"], width, height)
+
+    # the profiler separates the solver from the rest of the search, it is dropped again so that
+    # the next configuration of this process starts from zero
+    emd.profiler = Profiler()
+    try:
+        results = evaluate(sweepState["inputImages"], sweepState["inputLabels"], sweepState["queryImages"], sweepState["queryLabels"], settings, inputSignatures)
+        solveTime = emd.profiler.stages.get("solve", [0.0, 0])[0]
+    finally:
+        emd.profiler = None
+
+    queryCount = len(sweepState["queryImages"])
+    emdCorrectness = results["emdCorrectness"]
+    manhattanCorrectness = results["manhattanCorrectness"]
+
+    # search time covers the whole emd search of every query, bounds and bookkeeping included,
+    # solve time only the solver calls, sinkhorn has none since it solves every candidate at once
+    return {"width": width,
+            "height": height,
+            "emd_correct": emdCorrectness,
+            "manhattan_correct": manhattanCorrectness,
+            "emd_accuracy": emdCorrectness / queryCount,
+            "manhattan_accuracy": manhattanCorrectness / queryCount,
+            "ratio": emdCorrectness / manhattanCorrectness if manhattanCorrectness else float('nan'),
+            "wall_time": results["wallTime"],
+            "search_time": sum(results["emdSeconds"]),
+            "solve_time": solveTime,
+            "solves": sum(results["emdSolves"])}
+
+
+def runSweep(inputFilePath, queryFilePath, inputLabelsPath, queryLabelsPath, widths, heights, settings, storePath=None, workers=1):
+    configurations = [(width, height) for width in widths for height in heights]
+    datasets = (inputFilePath, queryFilePath, inputLabelsPath, queryLabelsPath, settings, storePath)
+
+    if workers > 1:
+        # configurations differ a lot in cost, so hand them out one at a time
+        with Pool(workers, initializer=openDatasets, initargs=datasets) as pool:
+            return pool.map(evaluateConfiguration, configurations, chunksize=1)
+
+    openDatasets(*datasets)
+    return [evaluateConfiguration(configuration) for configuration in configurations]
+
+
+def writeResults(filename, results):
+    with open(filename, mode='w', newline='') as resultFile:
+        writer = csv.DictWriter(resultFile, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def readResults(filename):
+    with open(filename, newline='') as resultFile:
+        results = list(csv.DictReader(resultFile))
+
+    # everything but the geometry is a float
+    for result in results:
+        for field in RESULT_FIELDS:
+            result[field] = int(result[field]) if field in ("width", "height", "solves") else float(result[field])
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d')
+    parser.add_argument('-q')
+    parser.add_argument('-l1')
+    parser.add_argument('-l2')
+    parser.add_argument('-o')
+    parser.add_argument('-widths', default="28,14,7")
+    parser.add_argument('-heights', default="28,14,7")
+    parser.add_argument('-workers', default="1")
+    parser.add_argument('-store')
+    parser.add_argument('-solver', default="transport", choices=["transport", "linprog", "grid"])
+    parser.add_argument('-search', default="prune", choices=["prune", "exhaustive"])
+    parser.add_argument('-emd-mode', default="exact", choices=["exact", "sinkhorn"])
+    parser.add_argument('-reg', default="1.0")
+    parser.add_argument('-sinkhorn-iters', default="200")
+    parser.add_argument('-memory', default="256")
+    args = parser.parse_args(argv)
+
+    widths = [int(width) for width in args.widths.split(",")]
+    heights = [int(height) for height in args.heights.split(",")]
+    settings = {"solver": args.solver, "search": args.search, "memoryBudget": int(args.memory) << 20,
+                "mode": args.emd_mode, "regularization": float(args.reg), "iterations": int(args.sinkhorn_iters)}
+
+    results = runSweep(args.d, args.q, args.l1, args.l2, widths, heights, settings, args.store, int(args.workers))
+    writeResults(args.o, results)
+
+
+if __name__ == "__main__":
+    main()
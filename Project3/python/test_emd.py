@@ -0,0 +1,110 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from emd import computeSignatures, kNearestNeighbors, manhattanNearestNeighbors, matrixEvaluation, prunedNearestNeighbors, signatureDistance, sinkhornDistances
+
+
+def duplicatedImages(randomImages):
+    images = randomImages(120, 1)
+
+    # every tenth image appears a second time further down, so its signature ties with the original
+    for index in range(0, 60, 10):
+        images[index + 60] = images[index]
+
+    # queries are noisy copies of the duplicated images, the tied pair is right at the top
+    random = np.random.RandomState(2)
+    queries = np.clip(images[0:60:10].astype(np.int64) + random.randint(-20, 21, (6, 28, 28)), 0, 255).astype(np.uint8)
+
+    return images, queries
+
+
+@pytest.mark.parametrize("solver", ["transport", "linprog"])
+@pytest.mark.parametrize("k", [1, 10])
+def test_pruned_search_matches_exhaustive_search(randomImages, solver, k):
+    images, queries = duplicatedImages(randomImages)
+    signatures = computeSignatures(images, 7, 7)
+
+    for querySignature in computeSignatures(queries, 7, 7):
+        exhaustive = kNearestNeighbors(querySignature, signatures, k, partial(signatureDistance, 7, 7, solver=solver))
+        pruned, _ = prunedNearestNeighbors(querySignature, signatures, k, 7, 7, solver)
+
+        assert pruned == exhaustive
+
+
+def test_tied_signatures_keep_the_lower_id(randomImages):
+    images, queries = duplicatedImages(randomImages)
+    signatures = computeSignatures(images, 7, 7)
+
+    # whatever was solved before, the two copies get the same distance and the lower id wins
+    for queryIndex, querySignature in enumerate(computeSignatures(queries, 7, 7)):
+        pruned, _ = prunedNearestNeighbors(querySignature, signatures, 1, 7, 7, 'transport')
+
+        assert pruned == [10 * queryIndex]
+
+
+@pytest.mark.parametrize("regularization,iterations,tolerance", [(1.0, 200, 0.1), (0.05, 3000, 0.05)])
+def test_sinkhorn_distances_are_close_to_emd(randomImages, regularization, iterations, tolerance):
+    signatures = computeSignatures(randomImages(6, 3), 7, 7)
+
+    distances = sinkhornDistances(signatures[0], signatures[1:], 7, 7, regularization, iterations)
+    exact = np.array([signatureDistance(7, 7, signatures[0], signature, 'transport') for signature in signatures[1:]])
+
+    assert distances == pytest.approx(exact, rel=tolerance)
+
+
+def test_sinkhorn_distances_stay_finite_for_small_regularizations(digitImages):
+    images = digitImages(300, 1)
+    queries = digitImages(20, 2)
+    signatures = computeSignatures(images, 7, 7)
+
+    # the scalings of some of these pairs overflow at 0.01, which gave nan distances
+    for regularization in (0.02, 0.01):
+        distances = sinkhornDistances(computeSignatures(queries[:1], 7, 7)[0], signatures, 7, 7, regularization, 200)
+
+        assert np.isfinite(distances).all()
+        assert (distances >= 0).all()
+
+
+@pytest.mark.parametrize("width,height", [(7, 7), (4, 7), (14, 4), (5, 5)])
+def test_signatures_use_the_image_row_stride(randomImages, width, height):
+    images = randomImages(3, 4).reshape(3, -1)
+    verticalSlots = 28 // height
+    horizontalSlots = 28 // width
+
+    for image, signature in zip(images, computeSignatures(images, width, height)):
+        # pixel by pixel, rows of a flat image are 28 pixels apart whatever the window width
+        expected = np.ones(verticalSlots * horizontalSlots)
+        for yIndex in range(verticalSlots):
+            for xIndex in range(horizontalSlots):
+                for y in range(yIndex * height, (yIndex + 1) * height):
+                    for x in range(xIndex * width, (xIndex + 1) * width):
+                        expected[yIndex * horizontalSlots + xIndex] += image[y * 28 + x]
+
+        assert signature == pytest.approx(expected / expected.sum(), abs=1e-15)
+
+
+def test_manhattan_search_with_no_queries(randomImages):
+    images = randomImages(30, 5)
+
+    # an empty idx file maps to zero images, the search then has nothing to answer
+    neighbors = manhattanNearestNeighbors(images[:0].reshape(0, 784), images.reshape(30, 784), 5)
+
+    assert neighbors.shape == (0, 5)
+
+
+def test_matrix_resume_checks_the_ground_distance(randomImages, tmp_path):
+    images = randomImages(12, 6).reshape(12, -1)
+    labels = np.arange(12) % 3
+    settings = {"width": 7, "height": 7, "solver": "transport", "mode": "exact", "memoryBudget": 256 << 20}
+    matrixPath = str(tmp_path / "matrix.npy")
+
+    matrixEvaluation(images, labels, images[:4], labels[:4], settings, matrixPath, 3, 4)
+
+    # linprog solves the same problem, so it resumes the matrix
+    matrixEvaluation(images, labels, images[:4], labels[:4], dict(settings, solver="linprog"), matrixPath, 3, 4)
+
+    # the grid solver measures with another ground distance, its distances are not in this matrix
+    with pytest.raises(ValueError, match="different data or settings"):
+        matrixEvaluation(images, labels, images[:4], labels[:4], dict(settings, solver="grid"), matrixPath, 3, 4)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from idx import REDUCED_MAGIC, ImageWriter, openImages, readHeader, writeImages
+
+
+def test_write_images_round_trip(tmp_path):
+    images = np.random.RandomState(1).randint(0, 256, (5, 28, 28)).astype(np.uint8)
+
+    writeImages(tmp_path / "images", images)
+
+    assert readHeader(tmp_path / "images", 3) == [2051, 5, 28, 28]
+    np.testing.assert_array_equal(openImages(tmp_path / "images"), images)
+
+
+def test_appended_batches_round_trip(tmp_path):
+    # latent vectors are written batch by batch, the number of images is only known at the end
+    batches = [np.random.RandomState(seed).randint(0, 256, (count, 1, 10)) for seed, count in ((1, 3), (2, 0), (3, 4))]
+
+    with ImageWriter(tmp_path / "latents", 1, 10, REDUCED_MAGIC) as writer:
+        for batch in batches:
+            writer.append(batch)
+
+    assert readHeader(tmp_path / "latents", 3) == [REDUCED_MAGIC, 7, 1, 10]
+    np.testing.assert_array_equal(openImages(tmp_path / "latents"), np.concatenate(batches))
+
+
+@pytest.mark.parametrize("value", [-1, 256])
+def test_values_outside_a_byte_are_rejected(tmp_path, value):
+    images = np.zeros((2, 28, 28), dtype=np.int64)
+    images[1, 3, 4] = value
+
+    with pytest.raises(ValueError):
+        writeImages(tmp_path / "images", images)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from emd import computeSignatures, signatureDistance, windowGeometry
+from transport import transportationSimplex
+
+
+def degenerateImages(randomImages):
+    images = randomImages(4, 1)
+
+    # all black, and the same image twice
+    return np.concatenate((images, np.zeros((1, 28, 28), dtype=np.uint8), images[:1]))
+
+
+@pytest.mark.parametrize("width,height", [(7, 7), (14, 7), (4, 4), (2, 2)])
+def test_transport_agrees_with_linprog(randomImages, width, height):
+    signatures = computeSignatures(degenerateImages(randomImages), width, height)
+
+    # every pair, including a pair of identical images and pairs with the uniform signature of the black image
+    pairs = [(0, 1), (0, 4), (4, 4), (0, 5), (5, 0), (2, 3)] if width > 2 else [(0, 1), (4, 4), (0, 5)]
+    for first, second in pairs:
+        transport = signatureDistance(width, height, signatures[first], signatures[second], 'transport')
+        linprog = signatureDistance(width, height, signatures[first], signatures[second], 'linprog')
+
+        assert transport == pytest.approx(linprog, abs=1e-6)
+
+
+@pytest.mark.parametrize("width,height", [(7, 7), (14, 7), (4, 4)])
+def test_identical_and_uniform_signatures(randomImages, width, height):
+    costs, _ = windowGeometry(width, height)
+    windowCount = len(costs)
+
+    signature = computeSignatures(randomImages(1, 2), width, height)[0]
+    uniform = np.full(windowCount, 1.0 / windowCount)
+
+    # ties between remaining supply and demand on every allocation of the initial basis
+    for supply in (signature, uniform):
+        distance, basis, _ = transportationSimplex(costs, supply, supply.copy())
+
+        assert distance == pytest.approx(0.0, abs=1e-12)
+        assert len(basis) == 2 * windowCount - 1
+
+
+@pytest.mark.parametrize("width,height", [(28, 28), (14, 14), (7, 7), (4, 7), (4, 4)])
+def test_grid_solver_is_the_manhattan_emd(randomImages, width, height):
+    signatures = computeSignatures(degenerateImages(randomImages), width, height)
+
+    # the grid solver moves mass along the grid, which is the emd with the manhattan distance of the centroids
+    _, centroids = windowGeometry(width, height)
+    costs = np.abs(centroids[:, None, :] - centroids[None, :, :]).sum(axis=2)
+
+    for first, second in [(0, 1), (4, 4), (0, 5), (2, 3)]:
+        distance, _, _ = transportationSimplex(costs, signatures[first], signatures[second])
+
+        assert signatureDistance(width, height, signatures[first], signatures[second], 'grid') == pytest.approx(distance, abs=1e-6)
@@ -0,0 +1,215 @@
+import numpy as np
+
+# reduced costs above -EPSILON are treated as non negative (optimality reached)
+# and flows above -EPSILON are treated as feasible when warm starting
+EPSILON = 1e-9
+
+
+def initialBasis(costs, supply, demand):
+    rowCount, columnCount = costs.shape
+
+    flows = np.zeros((rowCount, columnCount))
+    basis = []
+
+    remainingSupply = [float(value) for value in supply]
+    remainingDemand = [float(value) for value in demand]
+    rowDone = [False] * rowCount
+    columnDone = [False] * columnCount
+    openRows = rowCount
+    openColumns = columnCount
+
+    # least cost method: visit cells from cheapest to most expensive and
+    # allocate as much as possible, crossing out exactly one line per allocation
+    # so that we end up with a spanning tree of rowCount + columnCount - 1 cells
+    for cell in np.argsort(costs, axis=None, kind='stable'):
+        if len(basis) == rowCount + columnCount - 1:
+            break
+
+        i, j = divmod(int(cell), columnCount)
+        if rowDone[i] or columnDone[j]:
+            continue
+
+        flow = min(remainingSupply[i], remainingDemand[j])
+        flows[i, j] = flow
+        basis.append((i, j))
+
+        remainingSupply[i] -= flow
+        remainingDemand[j] -= flow
+
+        # the last allocation closes both lines, every other one only a single line
+        if len(basis) == rowCount + columnCount - 1:
+            break
+
+        # on a tie cross the row, unless it is the last open one: the columns left
+        # (with nothing to receive) still need a row to get their zero allocations from
+        if openColumns == 1 or (remainingSupply[i] <= remainingDemand[j] and openRows > 1):
+            rowDone[i] = True
+            openRows -= 1
+        else:
+            columnDone[j] = True
+            openColumns -= 1
+
+    return basis, flows
+
+
+def basisFlows(basis, supply, demand):
+    rowCount = len(supply)
+    columnCount = len(demand)
+
+    flows = np.zeros((rowCount, columnCount))
+
+    # nodes 0..rowCount-1 are rows, the rest are columns
+    remaining = [float(value) for value in supply] + [float(value) for value in demand]
+    degree = [0] * (rowCount + columnCount)
+    edges = [[] for _ in range(rowCount + columnCount)]
+
+    for (i, j) in basis:
+        degree[i] += 1
+        degree[rowCount + j] += 1
+        edges[i].append((i, j))
+        edges[rowCount + j].append((i, j))
+
+    # the flows of a spanning tree are unique: repeatedly peel off a leaf,
+    # whose only edge has to carry the whole remaining amount of the leaf
+    leaves = [node for node in range(rowCount + columnCount) if degree[node] == 1]
+    used = set()
+
+    while leaves:
+        node = leaves.pop()
+        if degree[node] != 1:
+            continue
+
+        edge = next(edge for edge in edges[node] if edge not in used)
+        used.add(edge)
+
+        i, j = edge
+        other = rowCount + j if node == i else i
+
+        flows[i, j] = remaining[node]
+        remaining[other] -= remaining[node]
+
+        degree[node] -= 1
+        degree[other] -= 1
+        if degree[other] == 1:
+            leaves.append(other)
+
+    return flows
+
+
+def potentials(costs, basis):
+    rowCount, columnCount = costs.shape
+
+    u = [None] * rowCount
+    v = [None] * columnCount
+
+    rowEdges = [[] for _ in range(rowCount)]
+    columnEdges = [[] for _ in range(columnCount)]
+    for (i, j) in basis:
+        rowEdges[i].append(j)
+        columnEdges[j].append(i)
+
+    # u_i + v_j = c_ij on every basic cell, fix u_0 = 0 and walk the tree
+    u[0] = 0.0
+    stack = [(True, 0)]
+
+    while stack:
+        isRow, index = stack.pop()
+        if isRow:
+            for j in rowEdges[index]:
+                if v[j] is None:
+                    v[j] = costs[index, j] - u[index]
+                    stack.append((False, j))
+        else:
+            for i in columnEdges[index]:
+                if u[i] is None:
+                    u[i] = costs[i, index] - v[index]
+                    stack.append((True, i))
+
+    return np.array(u), np.array(v)
+
+
+def findCycle(basis, rowCount, enteringRow, enteringColumn):
+    # adjacency of the basis tree, nodes as in basisFlows
+    edges = {}
+    for (i, j) in basis:
+        edges.setdefault(i, []).append((rowCount + j, (i, j)))
+        edges.setdefault(rowCount + j, []).append((i, (i, j)))
+
+    # search the unique tree path from the entering column back to the entering row
+    start = rowCount + enteringColumn
+    parents = {start: None}
+    stack = [start]
+
+    while stack:
+        node = stack.pop()
+        if node == enteringRow:
+            break
+        for (neighbor, edge) in edges.get(node, []):
+            if neighbor not in parents:
+                parents[neighbor] = (node, edge)
+                stack.append(neighbor)
+
+    path = []
+    node = enteringRow
+    while parents[node] is not None:
+        previous, edge = parents[node]
+        path.append(edge)
+        node = previous
+
+    # path goes row -> ... -> column, so the first edge touches the entering row
+    return path
+
+
+def transportationSimplex(costs, supply, demand, basis=None):
+    rowCount, columnCount = costs.shape
+    supply = np.asarray(supply, dtype=np.float64)
+    demand = np.asarray(demand, dtype=np.float64)
+
+    # warm start from a previous basis if it is still primal feasible
+    flows = None
+    if basis is not None:
+        flows = basisFlows(basis, supply, demand)
+        if flows.min() < -EPSILON:
+            flows = None
+
+    if flows is None:
+        basis, flows = initialBasis(costs, supply, demand)
+    else:
+        basis = list(basis)
+
+    iterations = 0
+
+    while True:
+        u, v = potentials(costs, basis)
+        reducedCosts = costs - u[:, None] - v[None, :]
+
+        entering = int(np.argmin(reducedCosts))
+        enteringRow, enteringColumn = divmod(entering, columnCount)
+
+        # no improving direction left, the current basis is optimal
+        if reducedCosts[enteringRow, enteringColumn] >= -EPSILON:
+            break
+
+        # the cycle alternates: entering cell gains flow, then every other cell loses it
+        path = findCycle(basis, rowCount, enteringRow, enteringColumn)
+        decreasing = path[0::2]
+        increasing = path[1::2]
+
+        leaving = min(decreasing, key=lambda cell: flows[cell])
+        theta = flows[leaving]
+
+        for cell in decreasing:
+            flows[cell] -= theta
+        for cell in increasing:
+            flows[cell] += theta
+        flows[enteringRow, enteringColumn] += theta
+        flows[leaving] = 0.0
+
+        basis.remove(leaving)
+        basis.append((enteringRow, enteringColumn))
+
+        iterations += 1
+
+    flows = np.maximum(flows, 0.0)
+
+    return float(np.sum(costs * flows)), basis, iterations